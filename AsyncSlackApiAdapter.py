@@ -0,0 +1,202 @@
+import asyncio
+import heapq
+from time import monotonic
+
+import aiohttp
+
+from SlackApiAdapter import (API_URL, DEFAULT_RETRIES, DEFAULT_TIMEOUT, DEFAULT_WAIT, Error, Interrupted, RateLimiter,
+                             Response, add_replies, find_threads, get_api_method, get_api_url)
+
+# requests in flight at the same time, shared by all coroutines of the adapter
+DEFAULT_CONCURRENCY = 100
+# seconds between two looks at a stopped rate limiter while waiting for it
+STOP_POLL = 0.5
+
+
+def _params(params):
+    # requests drops None parameters, aiohttp refuses them
+    return {key: value for key, value in (params or {}).items() if value is not None}
+
+
+class AsyncSlackApiAdapter:
+    """
+    asyncio counterpart of SlackApiAdapter.SlackApiAdapter on a pooled aiohttp session, with the same
+    Response/Error semantics, retry rules and rate limiter. Use it as an async context manager:
+
+        async with AsyncSlackApiAdapter(token, headers) as slack:
+            messages, users = await slack.get_channel_history(channel_id)
+    """
+
+    def __init__(self, token, headers=None,
+                 timeout=DEFAULT_TIMEOUT,
+                 session=None,
+                 rate_limit_retries=DEFAULT_RETRIES,
+                 rate_limiter=None,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 api_url=API_URL,
+                 keep_raw=False,
+                 projection=None):
+        self.headers = headers
+        self.token = token
+        self.timeout = timeout
+        self.session = session
+        self.own_session = session is None
+        self.rate_limit_retries = rate_limit_retries
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.concurrency = concurrency
+        self.api_url = api_url
+        self.keep_raw = keep_raw
+        self.projection = projection
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _acquire(self, api_method):
+        """wait for the rate limiter without blocking the loop, raises Interrupted once the limiter is stopped"""
+        deadline = monotonic() + self.rate_limiter.reserve(api_method)
+        # RateLimiter.stop() is called from another thread, the event can't be awaited
+        while not self.rate_limiter.stopped.is_set():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, STOP_POLL))
+        raise Interrupted()
+
+    async def _send(self, request_method, url, api_method, **kwargs):
+        await self._acquire(api_method)
+        async with self.semaphore:
+            async with self.session.request(request_method, url, **kwargs) as response:
+                return response.status, response.headers, await response.read(), response
+
+    async def _request(self, request_method, method, **kwargs):
+        if self.token:
+            kwargs.setdefault('params', {})['token'] = self.token
+            kwargs['headers'] = self.headers
+        kwargs['params'] = _params(kwargs.get('params'))
+        url = get_api_url(method, self.api_url)
+        api_method = get_api_method(method)
+
+        # while we have rate limit retries left, fetch the resource and back
+        # off as Slack's HTTP response suggests
+        for retry_num in range(self.rate_limit_retries):
+            status, headers, body, response = await self._send(request_method, url, api_method, **kwargs)
+
+            if status == 200:
+                break
+
+            # handle HTTP 429 as documented at
+            # https://api.slack.com/docs/rate-limits
+            if status == 429:
+                retry_in_seconds = int(headers.get('retry-after', DEFAULT_WAIT))
+                print("Rate limit hit. Retrying in {0} second{1}.".format(retry_in_seconds,
+                                                                          "s" if retry_in_seconds > 1 else ""))
+                self.rate_limiter.retry_after(api_method, retry_in_seconds)
+
+                continue
+
+            response.raise_for_status()
+        else:
+            # with no retries left, make one final attempt to fetch the
+            # resource, but do not handle too_many status differently
+            status, headers, body, response = await self._send(request_method, url, api_method, **kwargs)
+            response.raise_for_status()
+
+        response = Response(body, self.keep_raw)
+        if not response.successful:
+            raise Error(response.error)
+
+        return response
+
+    async def get(self, api, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return await self._request('GET', api, **kwargs)
+
+    async def post(self, api, **kwargs):
+        return await self._request('POST', api, **kwargs)
+
+    async def get_conversations(self, types):
+        if isinstance(types, (list, tuple)):
+            types = ','.join(types)
+        conversations_list = []
+        cursor = None
+        while True:
+            response = await self.get('conversations.list',
+                                      params={'cursor': cursor, 'types': types, 'limit': 1000})
+            conversations_list.extend(response.body['channels'])
+            cursor = response.body['response_metadata']['next_cursor']
+            if cursor == '':
+                return conversations_list
+
+    async def get_replies(self, channel_id, thread_ts):
+        replies = {}
+        cursor = None
+
+        while True:
+            response = (await self.get('conversations.replies',
+                                       params={'channel': channel_id, 'ts': thread_ts, 'cursor': cursor,
+                                               'limit': 1000})).body
+
+            if self.projection is not None:
+                self.projection.apply(response['messages'])
+            # every page starts with the parent message, keyed by 'ts' it is only kept once
+            replies.update((reply['ts'], reply) for reply in response["messages"])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not response.get("has_more") or not cursor:
+                break
+
+        replies.pop(thread_ts, None)
+        return sorted(replies.values(), key=lambda reply: reply["ts"])
+
+    async def get_channel_history(self, channel_id, exclude_threads=False, oldest=0):
+        messages = []
+        users = set()
+        latest = None
+
+        while True:
+            response = (await self.get('conversations.history',
+                                       params={'channel': channel_id, 'latest': latest, 'oldest': oldest,
+                                               'limit': 1000})).body
+            if self.projection is not None:
+                self.projection.apply(response['messages'])
+            messages.extend(response['messages'])
+            if not response['has_more'] or not response['messages']:
+                break
+            latest = messages[-1]['ts']  # -1 means last element in a list
+
+        messages.sort(key=lambda t: t['ts'])
+        threads = find_threads(messages, exclude_threads, users)
+        if threads:
+            print(f"Fetching {len(threads)} threads in {channel_id}")
+        thread_replies = await asyncio.gather(*(self.get_replies(channel_id, message['thread_ts'])
+                                                for message in threads))
+        thread_replies = add_replies(threads, thread_replies, users)
+        if thread_replies:
+            messages = list(heapq.merge(messages, *thread_replies, key=lambda t: t['ts']))
+        return messages, users
+
+    async def get_users(self):
+        members_list = []
+        cursor = None
+        while True:
+            response = await self.get('users.list', params={'limit': 1000, 'cursor': cursor, 'presence': 0})
+            members_list.extend(response.body['members'])
+            cursor = response.body['response_metadata']['next_cursor']
+            if cursor == '':
+                break
+            print(f"Fetched {len(members_list)} team members")
+        print(f"Total users fetched: {len(members_list)}")
+        return members_list
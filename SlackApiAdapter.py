@@ -1,27 +1,277 @@
 import requests
+import heapq
 import json
 import sys
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter
 
+import json_backend
 
+
+API_URL = 'https://slack.com/api/'
 DEFAULT_TIMEOUT = 60
 DEFAULT_RETRIES = 3
 # seconds to wait after a 429 error if Slack's API doesn't provide one
 DEFAULT_WAIT = 20
+# requests per minute allowed for each API method, see https://api.slack.com/docs/rate-limits
+RATE_LIMIT_TIERS = {
+    'conversations.history': 50,  # Tier 3
+    'conversations.replies': 50,  # Tier 3
+    'conversations.list': 20,  # Tier 2
+    'users.list': 20,  # Tier 2
+    'users.info': 100,  # Tier 4
+    'files.slack.com': 300,  # file downloads aren't documented, stay polite
+}
+# requests per minute for methods not listed above (Tier 2)
+DEFAULT_RATE_LIMIT = 20
+# requests that may be sent back to back before the per-minute rate applies
+DEFAULT_BURST = 3
+# hosts a session keeps connection pools for (slack.com, files.slack.com)
+POOL_HOSTS = 4
+# threads whose replies are fetched at the same time, shared by all conversations
+DEFAULT_REPLY_WORKERS = 8
+# errors of users.info for a user that can't be looked up, any other error fails the lookup
+USER_LOOKUP_ERRORS = ('user_not_found', 'user_not_visible')
+# message fields the export relies on (threads, renames, files), a FieldProjection never drops them
+REQUIRED_FIELDS = frozenset([
+    'ts', 'thread_ts', 'reply_count', 'reply_users_count', 'latest_reply', 'replies', 'subtype', 'name', 'old_name',
+    'user', 'files',
+])
+# named projections, each with the fields it allows and the fields it denies
+PROJECTION_PRESETS = {
+    # what slack-export-viewer renders, drops blocks, user_profile copies, edit metadata and the like
+    'viewer-minimal': {
+        'allow': ['type', 'text', 'parent_user_id', 'attachments', 'reactions', 'bot_id', 'username', 'icons',
+                  'upload', 'display_as_bot'],
+        'deny': [],
+    },
+    # everything but the rich text blocks, 'text' holds the same message
+    'no-blocks': {
+        'allow': None,
+        'deny': ['blocks', 'user_profile'],
+    },
+}
 
 
 class Error(Exception):
     pass
 
 
-def get_api_url(method):
-    return 'https://slack.com/api/{}'.format(method)
+
+class Interrupted(Exception):
+    """the export is stopping, raised instead of sending a request once RateLimiter.stop() was called"""
+
+
+def get_api_url(method, api_url=API_URL):
+    return '{}{}'.format(api_url, method)
+
+
+def create_session(pool_size):
+    """
+    requests session keeping up to pool_size connections per host alive, pool_size should match the number of
+    threads using the session at the same time
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def get_connection_stats(session):
+    """count the requests and new connections of all connection pools of a session created by create_session"""
+    stats = {'requests': 0, 'connections': 0}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+    return stats
+
+
+def get_api_method(api):
+    """strip the query string from an API path, 'users.list?limit=1000' -> 'users.list'"""
+    return api.split('?', 1)[0]
+
+
+def time_windows(oldest, latest, count):
+    """
+    split the time from oldest to latest into count windows of equal length, neighbouring windows share a boundary
+    Returns:
+        list of (oldest, latest) 'ts' strings, the last window ends at latest
+    """
+    start = float(oldest)
+    step = (float(latest) - start) / count
+    bounds = ['{0:.6f}'.format(start + step * i) for i in range(count)] + [latest]
+    return list(zip(bounds, bounds[1:]))
+
+
+def find_threads(messages, exclude_threads, users):
+    """mark the thread parents in messages, collect their authors and return the parents whose replies are needed"""
+    threads = []
+    if exclude_threads:
+        for message in messages:
+            if message.get('reply_count') is not None:
+                message['replies'] = []
+                users.add(message.get('user'))
+        return threads
+
+    for message in messages:
+        users.add(message.get('user'))
+        if message.get('reply_count') == 0 and message.get('reply_users_count') == 0:
+            message['replies'] = []
+        elif message.get('reply_count'):
+            threads.append(message)
+    return threads
+
+
+def add_replies(threads, thread_replies, users):
+    """
+    list the replies of every thread in its parent and collect their authors
+    Returns:
+        list of reply lists to merge into the history, each sorted by 'ts'
+    """
+    history_replies = []
+    for message, rp in zip(threads, thread_replies):
+        replies = []
+        for reply in rp:
+            message.setdefault('replies', []).append({'user': reply.get('user'), 'ts': reply['ts']})
+            # broadcast replies are part of the channel history already
+            if reply.get('subtype') == 'thread_broadcast':
+                continue
+            users.add(reply.get('user'))
+            replies.append(reply)
+        history_replies.append(replies)
+    return history_replies
+
+
+class TokenBucket(object):
+    def __init__(self, rate_per_minute, burst=DEFAULT_BURST):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.last = monotonic()
+
+    def reserve(self, now):
+        """take a token and return how many seconds the caller has to wait before using it"""
+        # self.last is in the future while the bucket is blocked by a Retry-After
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        self.tokens -= 1
+        return max(0.0, self.last - now) + max(0.0, -self.tokens) / self.rate
+
+    def block(self, now, seconds):
+        """don't hand out tokens for the next seconds, then start from an empty bucket"""
+        self.tokens = min(self.tokens, 0)
+        self.last = max(self.last, now + seconds)
+
+
+class RateLimiter(object):
+    """
+    Token bucket per API method tier, shared by every thread that talks to Slack.
+    A Retry-After received by one caller holds back all callers of the same method.
+    """
+
+    def __init__(self, tiers=None, default_rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_BURST, scale=1.0):
+        """
+        Args:
+            scale: factor applied to every rate, e.g. 0.5 leaves half of the quota to other clients of the token
+        """
+        self.tiers = RATE_LIMIT_TIERS if tiers is None else tiers
+        self.default_rate = default_rate
+        self.scale = scale
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # statistics
+        self.throttled_seconds = 0.0
+        self.rate_limited = 0
+
+    def rate(self, method):
+        """requests per minute allowed for the method"""
+        return self.tiers.get(method, self.default_rate) * self.scale
+
+    def _bucket(self, method):
+        if method not in self.buckets:
+            self.buckets[method] = TokenBucket(self.rate(method), self.burst)
+        return self.buckets[method]
+
+    def reserve(self, method):
+        """reserve a request slot for the method, returns the seconds to wait before sending it"""
+        with self.lock:
+            wait = self._bucket(method).reserve(monotonic())
+            self.throttled_seconds += wait
+        return wait
+
+    def acquire(self, method):
+        """block until a request to the method may be sent, raises Interrupted once the limiter is stopped"""
+        wait = self.reserve(method)
+        if self.stopped.wait(wait):
+            raise Interrupted()
+        return wait
+
+    def stop(self):
+        """make every caller waiting for a request, and every later one, raise Interrupted"""
+        self.stopped.set()
+
+    def retry_after(self, method, seconds):
+        """Slack answered with HTTP 429, hold back every caller of the method"""
+        with self.lock:
+            self._bucket(method).block(monotonic(), seconds)
+            self.rate_limited += 1
+
+
+class FieldProjection(object):
+    """
+    Remove unneeded fields from messages as their pages arrive, the fields in REQUIRED_FIELDS are always kept
+    Args:
+        allow: fields to keep, None keeps every field that isn't denied
+        deny: fields to drop
+    """
+
+    def __init__(self, allow=None, deny=None):
+        self.allow = None if allow is None else frozenset(allow) | REQUIRED_FIELDS
+        self.deny = frozenset(deny or ()) - REQUIRED_FIELDS
+
+    @classmethod
+    def from_preset(cls, name=None, allow=None, deny=None):
+        """a preset of PROJECTION_PRESETS extended by more allowed and denied fields"""
+        preset = PROJECTION_PRESETS[name] if name else {'allow': None, 'deny': []}
+        if preset['allow'] is not None or allow is not None:
+            allow = list(preset['allow'] or ()) + list(allow or ())
+        return cls(allow, list(preset['deny']) + list(deny or ()))
+
+    def key(self):
+        """the kept and dropped fields as a string, '' if every field is kept"""
+        if self.allow is None and not self.deny:
+            return ''
+        allow = '*' if self.allow is None else ','.join(sorted(self.allow))
+        return 'allow={0};deny={1}'.format(allow, ','.join(sorted(self.deny)))
+
+    def apply(self, messages):
+        """project a list of messages in place"""
+        for message in messages:
+            for field in [field for field in message if
+                          field in self.deny or (self.allow is not None and field not in self.allow)]:
+                del message[field]
+        return messages
 
 
 class Response(object):
-    def __init__(self, body):
-        self.raw = body
-        self.body = json.loads(body)
+    def __init__(self, body, keep_raw=False):
+        """
+        Args:
+            body: str or bytes of the response
+            keep_raw: keep body as raw, otherwise only the decoded document is held in memory
+        """
+        self.raw = body if keep_raw else None
+        self.body = json_backend.loads(body)
         self.successful = self.body['ok']
         self.error = self.body.get('error')
 
@@ -33,25 +283,67 @@ class SlackApiAdapter:
     def __init__(self, token, headers=None,
                  timeout=DEFAULT_TIMEOUT,
                  session=None,
-                 rate_limit_retries=DEFAULT_RETRIES):
+                 rate_limit_retries=DEFAULT_RETRIES,
+                 rate_limiter=None,
+                 reply_workers=DEFAULT_REPLY_WORKERS,
+                 pool_size=None,
+                 api_url=API_URL,
+                 metrics=None,
+                 keep_raw=False,
+                 reply_cache=None,
+                 projection=None,
+                 profiler=None):
+        """
+        Args:
+            metrics: export_metrics.ExportMetrics recording every request, None records nothing
+            keep_raw: keep the undecoded body of every Response in Response.raw
+            reply_cache: reply_cache.ReplyCache serving the threads that haven't changed since they were fetched
+            projection: FieldProjection applied to every page of messages and replies
+            profiler: export_metrics.Profiler the adapter's worker threads run their tasks under
+        """
         self.headers = headers
         self.token = token
         self.timeout = timeout
-        self.session = session
+        # the adapter keeps its own keep-alive connections unless a session is passed in
+        self.own_session = session is None
+        self.session = session or create_session(pool_size or reply_workers + 1)
         self.rate_limit_retries = rate_limit_retries
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.api_url = api_url
+        self.reply_workers = reply_workers
+        self.reply_executor = None
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.keep_raw = keep_raw
+        self.reply_cache = reply_cache
+        self.projection = projection
+        self.profiler = profiler
+
+    def _send(self, request_method, url, api_method, **kwargs):
+        """wait for the rate limiter and send one request, timing it when metrics are recorded"""
+        throttled = self.rate_limiter.acquire(api_method)
+        if self.metrics is None:
+            return request_method(url, timeout=self.timeout, **kwargs)
+
+        started = perf_counter()
+        response = request_method(url, timeout=self.timeout, **kwargs)
+        # Content-Length is the size on the wire, the body may have been decompressed
+        received = int(response.headers.get('Content-Length') or len(response.content))
+        self.metrics.record_request(api_method, perf_counter() - started, received)
+        self.metrics.record_throttled(api_method, throttled)
+        return response
 
     def _request(self, request_method, method, **kwargs):
         if self.token:
             kwargs.setdefault('params', {})['token'] = self.token
             kwargs['headers'] = self.headers
-        url = get_api_url(method)
+        url = get_api_url(method, self.api_url)
+        api_method = get_api_method(method)
 
         # while we have rate limit retries left, fetch the resource and back
         # off as Slack's HTTP response suggests
         for retry_num in range(self.rate_limit_retries):
-            response = request_method(
-                url, timeout=self.timeout, **kwargs
-            )
+            response = self._send(request_method, url, api_method, **kwargs)
 
             if response.status_code == requests.codes.ok:
                 break
@@ -62,7 +354,10 @@ class SlackApiAdapter:
                 retry_in_seconds = int(response.headers.get('retry-after', DEFAULT_WAIT))
                 print("Rate limit hit. Retrying in {0} second{1}.".format(retry_in_seconds,
                                                                           "s" if retry_in_seconds > 1 else ""))
-                sleep(retry_in_seconds)
+                # the next acquire() waits, together with every other caller of the method
+                self.rate_limiter.retry_after(api_method, retry_in_seconds)
+                if self.metrics is not None:
+                    self.metrics.record_rate_limited(api_method)
 
                 continue
 
@@ -70,12 +365,11 @@ class SlackApiAdapter:
         else:
             # with no retries left, make one final attempt to fetch the
             # resource, but do not handle too_many status differently
-            response = request_method(
-                url, timeout=self.timeout, **kwargs
-            )
+            response = self._send(request_method, url, api_method, **kwargs)
             response.raise_for_status()
 
-        response = Response(response.text)
+        # the bytes are decoded by the JSON backend directly, without building a str first
+        response = Response(response.content, self.keep_raw)
         if not response.successful:
             raise Error(response.error)
 
@@ -93,16 +387,14 @@ class SlackApiAdapter:
         )
 
     def get(self, api, **kwargs):
-        return self._request(
-            self._session_get if self.session else requests.get,
-            api, **kwargs
-        )
+        return self._request(self._session_get, api, **kwargs)
 
     def post(self, api, **kwargs):
-        return self._request(
-            self._session_post if self.session else requests.post,
-            api, **kwargs
-        )
+        return self._request(self._session_post, api, **kwargs)
+
+    def connection_stats(self):
+        """requests sent and connections opened by the adapter's session, a low ratio means connections are reused"""
+        return get_connection_stats(self.session)
 
     def _conversations_list_request(self, cursor=None, exclude_archived=None, types=None, limit=1000):
         if isinstance(types, (list, tuple)):
@@ -129,16 +421,20 @@ class SlackApiAdapter:
             cursor = req_conversations.body['response_metadata']['next_cursor']
         return conversations_list
 
-    def _conversations_history_request(self, channel, cursor=None, limit=1000, latest=None, oldest=None):
+    def _conversations_history_request(self, channel, cursor=None, limit=1000, latest=None, oldest=None,
+                                       inclusive=False):
         messages_list = self.get('conversations.history',
                                  params={
                                      'channel': channel,
                                      'cursor': cursor,
                                      'latest': latest,
                                      'oldest': oldest,
+                                     'inclusive': 1 if inclusive else None,
                                      'limit': limit
                                  }
                                  )
+        if self.projection is not None:
+            self.projection.apply(messages_list.body['messages'])
         return messages_list
 
     def _replies_request(self, channel, thread_ts, cursor=None, limit=1000, latest=None, oldest=None):
@@ -153,102 +449,177 @@ class SlackApiAdapter:
                 'limit': limit
             }
         )
+        if self.projection is not None:
+            self.projection.apply(replies_list.body['messages'])
         return replies_list
 
-    # TODO: use cursor logic
     def get_replies(self, channel_id, thread_ts):
-        replies = []
-        last_timestamp = None
+        replies = {}
+        cursor = None
 
         while True:
-            try:
-                response = self._replies_request(channel=channel_id,
-                                                 thread_ts=thread_ts,
-                                                 latest=last_timestamp,
-                                                 oldest=0).body
-            #   print(response)
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429:
-                    retryInSeconds = int(e.response.headers["Retry-After"])
-                    print("Rate limit hit. Retrying in {0} second{1}.".format(retryInSeconds,
-                                                                              "s" if retryInSeconds > 1 else ""))
-                    sleep(retryInSeconds)
-                    response = self._replies_request(channel=channel_id,
-                                                     thread_ts=thread_ts,
-                                                     latest=last_timestamp,
-                                                     oldest=0).body
-
-            replies.extend(response["messages"])
-            if response["has_more"]:
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                last_timestamp = replies[-1]["ts"]  # -1 means last element in a list
-                sleep(1)  # Respect the Slack API rate limit
-            else:
+            response = self._replies_request(channel=channel_id,
+                                             thread_ts=thread_ts,
+                                             cursor=cursor).body
+
+            # every page starts with the parent message, keyed by 'ts' it is only kept once
+            replies.update((reply['ts'], reply) for reply in response["messages"])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not response.get("has_more") or not cursor:
                 break
-        if last_timestamp is not None:
-            print("")
 
-        replies.sort(key=lambda replies: replies["ts"])
-        replies = replies[1:]
-        return replies
+        replies.pop(thread_ts, None)
+        return sorted(replies.values(), key=lambda reply: reply["ts"])
+
+    def _reply_executor(self):
+        with self.lock:
+            if self.reply_executor is None:
+                self.reply_executor = ThreadPoolExecutor(max_workers=self.reply_workers,
+                                                         thread_name_prefix='replies')
+            return self.reply_executor
+
+    def _task(self, func):
+        """func as run on the adapter's worker threads, under the profiler if there is one"""
+        return func if self.profiler is None else self.profiler.wrap(func)
+
+    def get_threads(self, channel_id, thread_ts_list):
+        """fetch the replies of many threads concurrently, results are in the order of thread_ts_list"""
+        return self._reply_executor().map(self._task(lambda thread_ts: self.get_replies(channel_id, thread_ts)),
+                                          thread_ts_list)
+
+    def close(self):
+        if self.reply_executor is not None:
+            self.reply_executor.shutdown()
+            self.reply_executor = None
+        if self.own_session:
+            self.session.close()
+
+    def iter_history_pages(self, channel_id, oldest=0, latest=None):
+        """yield the pages of conversations.history, newest messages first"""
+        while True:
+            response = self._conversations_history_request(channel=channel_id, latest=latest,
+                                                           oldest=oldest).body
+            messages = response['messages']
+            if not messages:
+                break
+            if self.metrics is not None:
+                self.metrics.record_page(channel_id)
+            # take the cursor before handing out the page, consumers may reorder it
+            latest = messages[-1]['ts']  # -1 means last element in a list
+            yield messages
+            if not response['has_more']:
+                break
 
-    def get_channel_history(self, channel_id, exclude_threads=False):
-        last_timestamp = None
+    def get_history_page(self, channel_id, oldest=0, latest=None):
+        """one page of conversations.history, newest messages first, and whether the history has more pages"""
+        response = self._conversations_history_request(channel=channel_id, latest=latest, oldest=oldest).body
+        return response['messages'], response['has_more']
+
+    def _attach_replies(self, channel_id, messages, exclude_threads, users):
+        """
+        mark thread parents of a sorted list of messages, collect their authors and fetch their replies
+        Returns:
+            list of reply lists, each sorted by 'ts'
+        """
+        threads = find_threads(messages, exclude_threads, users)
+        if threads:
+            print(f"Fetching {len(threads)} threads in {channel_id}")
+        return add_replies(threads, self._thread_replies(channel_id, threads), users)
+
+    def _thread_replies(self, channel_id, threads):
+        """replies of every thread parent, only the threads that changed since they were cached are fetched"""
+        if self.reply_cache is None:
+            return self.get_threads(channel_id, [message['thread_ts'] for message in threads])
+
+        thread_replies = [self.reply_cache.get(channel_id, message) for message in threads]
+        changed = [i for i, replies in enumerate(thread_replies) if replies is None]
+        fetched = self.get_threads(channel_id, [threads[i]['thread_ts'] for i in changed])
+        for i, replies in zip(changed, fetched):
+            self.reply_cache.put(channel_id, threads[i], replies)
+            thread_replies[i] = replies
+        return thread_replies
+
+    def iter_channel_history(self, channel_id, exclude_threads=False, oldest=0, latest=None, users=None):
+        """
+        Stream the history of a channel one page at a time, replies are merged into the page of their parent.
+        Pages come newest first, messages within a page are sorted by 'ts'.
+        Args:
+            latest: only messages older than this 'ts' are fetched, None starts at the newest message
+            users: set collecting the ids of the message authors
+        """
+        users = set() if users is None else users
+        for page in self.iter_history_pages(channel_id, oldest=oldest, latest=latest):
+            page.reverse()
+            thread_replies = self._attach_replies(channel_id, page, exclude_threads, users)
+            yield list(heapq.merge(page, *thread_replies, key=lambda t: t['ts']))
+
+    def _window_history(self, channel_id, oldest, latest):
+        """all messages of a time window, 'ts' from oldest to latest included, following the cursor"""
         messages = []
-        users = set()
-
+        cursor = None
         while True:
-            try:
-                response = self._conversations_history_request(channel=channel_id, latest=last_timestamp, oldest=0).body
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429:
-                    retryInSeconds = int(e.response.headers['Retry-After'])
-                    print(u"Rate limit hit. Retrying in {0} second{1}.".format(retryInSeconds,
-                                                                               "s" if retryInSeconds > 1 else ""))
-                    sleep(retryInSeconds)
-                    response = self._conversations_history_request(channel=channel_id, latest=last_timestamp,
-                                                                   oldest=0).body
-
+            response = self._conversations_history_request(channel=channel_id, cursor=cursor, latest=latest,
+                                                           oldest=oldest, inclusive=True).body
             messages.extend(response['messages'])
+            if self.metrics is not None:
+                self.metrics.record_page(channel_id)
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not response.get('has_more') or not cursor:
+                return messages
+
+    def _sharded_history(self, channel_id, oldest, shards, created):
+        """
+        fetch the newest page, then split the rest of the history into time windows fetched concurrently
+        Returns:
+            the messages in no particular order
+        """
+        response = self._conversations_history_request(channel=channel_id, oldest=oldest).body
+        if self.metrics is not None:
+            self.metrics.record_page(channel_id)
+        messages = {message['ts']: message for message in response['messages']}
+        # a history of one page isn't worth the requests of empty windows
+        if not response['has_more'] or not response['messages']:
+            return list(messages.values())
+
+        windows = time_windows(max(float(oldest), float(created)), response['messages'][-1]['ts'], shards)
+        # imported or converted conversations have messages older than 'created', the first window takes them too
+        windows[0] = (str(oldest), windows[0][1])
+        print(f"Fetching the history of {channel_id} in {len(windows)} windows")
+        with ThreadPoolExecutor(max_workers=len(windows), thread_name_prefix='history') as executor:
+            # windows share their boundaries, messages on them are fetched twice
+            for window in executor.map(self._task(lambda window: self._window_history(channel_id, *window)), windows):
+                messages.update((message['ts'], message) for message in window)
+        # like in a sequential fetch, oldest itself is not part of the history
+        messages.pop(str(oldest), None)
+        return list(messages.values())
+
+    def get_channel_history(self, channel_id, exclude_threads=False, oldest=0, shards=1, created=0):
+        """
+        Args:
+            shards: number of time windows the history older than the first page is split into and fetched
+                    concurrently, 1 walks the history one page after the other
+            created: 'created' time of the conversation from conversations.list, the windows split the time after it
+        """
+        messages = []
+        users = set()
 
-            if response['has_more']:
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                last_timestamp = messages[-1]['ts']  # -1 means last element in a list
-                sleep(1)  # Respect the Slack API rate limit
-            else:
-                break
+        if shards > 1:
+            messages = self._sharded_history(channel_id, oldest, shards, created)
+        else:
+            pages = 0
+            for page in self.iter_history_pages(channel_id, oldest=oldest):
+                if pages:
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
+                messages.extend(page)
+                pages += 1
+            if pages > 1:
+                print("")
 
-        if last_timestamp is not None:
-            print("")
         messages.sort(key=lambda t: t['ts'])
-        if exclude_threads:
-            for i, message in enumerate(messages, 0):
-                if message.get('reply_count') is not None:
-                    messages[i]['replies'] = []
-                    users.add(messages[i].get('user'))
-        else:
-            replies = []
-            for i, message in enumerate(messages, 0):
-                users.add(messages[i].get('user'))
-                if message.get('reply_count') == 0 and message.get('reply_users_count') == 0:
-                    messages[i]['replies'] = []
-                    continue
-                if message.get('reply_count'):
-                    print(f"Thread found in {channel_id} messages {i}/{len(messages)}")
-                    rp = self.get_replies(channel_id, message["thread_ts"])
-                    for reply_pos, reply in enumerate(rp, 1):
-                        if messages[i].get('replies'):
-                            messages[i]['replies'].append({'user': reply.get('user'), 'ts': reply['ts']})
-                        else:
-                            messages[i]['replies'] = [{'user': reply.get('user'), 'ts': reply['ts']}]
-                        if reply.get('subtype') == 'thread_broadcast':
-                            continue
-                        users.add(reply.get('user'))
-                        replies.append(reply)
-            messages.extend(replies)
-            messages.sort(key=lambda t: t['ts'])
+        thread_replies = self._attach_replies(channel_id, messages, exclude_threads, users)
+        if thread_replies:
+            messages = list(heapq.merge(messages, *thread_replies, key=lambda t: t['ts']))
         return messages, users
 
     def _users_request(self, presence=False, request_limit=1000, cursor=None):
@@ -257,15 +628,35 @@ class SlackApiAdapter:
             re += "&cursor={cursor}".format(cursor=cursor)
         return self.get(re, params={'presence': int(presence)})
 
-    def get_users(self):
-        members_list = []
-        req_members = self._users_request()
-        members_list.extend(req_members.body['members'])
-        cursor = req_members.body['response_metadata']['next_cursor']
-        while cursor != '':
+    def iter_users(self):
+        """yield the members of the workspace one users.list page at a time"""
+        cursor = None
+        while True:
             req_members = self._users_request(cursor=cursor)
-            members_list.extend(req_members.body['members'])
+            yield req_members.body['members']
             cursor = req_members.body['response_metadata']['next_cursor']
-            print(f"Fetched {len(members_list)} team members")
+            if cursor == '':
+                break
+
+    def get_users(self):
+        members_list = []
+        for page_num, members in enumerate(self.iter_users()):
+            members_list.extend(members)
+            if page_num:
+                print(f"Fetched {len(members_list)} team members")
         print(f"Total users fetched: {len(members_list)}")
         return members_list
+
+    def get_user(self, user_id):
+        """profile of one user from users.info, None if the user can't be looked up"""
+        try:
+            return self.get('users.info', params={'user': user_id}).body['user']
+        except Error as error:
+            # user_not_visible is returned for members of other workspaces in shared channels
+            if str(error) in USER_LOOKUP_ERRORS:
+                return None
+            raise
+
+    def get_users_info(self, user_ids):
+        """look up many users concurrently, results are in the order of user_ids"""
+        return self._reply_executor().map(self._task(self.get_user), user_ids)
@@ -0,0 +1,302 @@
+"""
+Offline stand-in for the parts of the Slack API used by slack_export.py.
+
+Serves a synthetic workspace on conversations.list, conversations.history, conversations.replies, users.list and
+users.info under /api/, the attachments at the paths files.slack.com has them (/files-pri/...), and simulates
+Slack's per-method rate limit tiers with HTTP 429 + Retry-After. Run it on its own:
+
+    python bench/fake_slack.py --channels 20 --messages 5000 --port 8080
+    python slack_export.py --token xoxc-fake --cookie fake --publicChannels \
+        --apiUrl http://127.0.0.1:8080/api/ --filesUrl http://127.0.0.1:8080
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# requests per minute of each method, mirrors the tiers documented at https://api.slack.com/docs/rate-limits
+RATE_LIMIT_TIERS = {
+    'conversations.list': 20,
+    'conversations.history': 50,
+    'conversations.replies': 50,
+    'users.list': 20,
+    'users.info': 100,
+    'files.slack.com': 300,
+}
+DEFAULT_START = 1500000000
+
+
+def make_ts(seconds, sequence):
+    return '{0}.{1:06d}'.format(int(seconds), sequence % 1000000)
+
+
+class Workspace(object):
+    """
+    Synthetic workspace
+    Args:
+        channels: number of public channels, the exporting user is a member of all of them
+        messages: top-level messages per channel
+        thread_density: share of messages that start a thread
+        replies: replies per thread
+        file_density: share of messages with an attachment on files.slack.com
+        file_size: size of every attachment in bytes
+        users: members of the workspace, messages are written by the first tenth of them
+        imported: messages per channel older than the channel's 'created' time, like in an imported channel
+    """
+
+    def __init__(self, channels=10, messages=1000, thread_density=0.1, replies=5, file_density=0.02,
+                 file_size=64 * 1024, users=1000, seed=1, imported=0):
+        rng = random.Random(seed)
+        self.file_size = file_size
+        self.users = [{'id': 'U{0:07d}'.format(i), 'name': 'user{0}'.format(i), 'real_name': 'User {0}'.format(i)}
+                      for i in range(users)]
+        authors = [user['id'] for user in self.users[:max(1, users // 10)]]
+        self.channels = []
+        # channel id -> messages sorted by 'ts', (channel id, thread_ts) -> replies sorted by 'ts'
+        self.history = {}
+        self.replies = {}
+        # attachment path -> (size, query string the file is only served with)
+        self.files = {}
+        sequence = 0
+        for channel_num in range(channels):
+            channel_id = 'C{0:07d}'.format(channel_num)
+            channel = {'id': channel_id, 'name': 'channel-{0}'.format(channel_num), 'is_channel': True,
+                       'is_member': True, 'created': DEFAULT_START, 'num_members': len(authors)}
+            self.channels.append(channel)
+            seconds = DEFAULT_START
+            channel_messages = []
+            for message_num in range(messages):
+                seconds += rng.randint(1, 3600)
+                if message_num == imported and imported:
+                    channel['created'] = seconds
+                sequence += 1
+                ts = make_ts(seconds, sequence)
+                message = {'type': 'message', 'ts': ts, 'user': rng.choice(authors),
+                           'text': 'message {0} in {1}'.format(message_num, channel_id)}
+                if rng.random() < file_density:
+                    file_id = 'F{0:09d}'.format(sequence)
+                    path = '/files-pri/T0000000-{0}/attachment.bin'.format(file_id)
+                    # every other file is only served with the token in its URL, like a public file link
+                    query = 't={0}'.format(file_id.lower()) if len(self.files) % 2 else ''
+                    self.files[path] = (file_size, query)
+                    url = 'https://files.slack.com' + path + ('?' + query if query else '')
+                    message['files'] = [{'id': file_id, 'size': file_size, 'mode': 'hosted', 'url_private': url,
+                                         'url_private_download': 'https://files.slack.com' + path + '?download=1'}]
+                if rng.random() < thread_density and replies:
+                    thread = []
+                    for reply_num in range(replies):
+                        sequence += 1
+                        thread.append({'type': 'message', 'ts': make_ts(seconds + reply_num + 1, sequence),
+                                       'thread_ts': ts, 'user': rng.choice(authors),
+                                       'text': 'reply {0} to {1}'.format(reply_num, ts)})
+                    message.update(thread_ts=ts, reply_count=replies, reply_users_count=len(
+                        {reply['user'] for reply in thread}), latest_reply=thread[-1]['ts'])
+                    self.replies[(channel_id, ts)] = [message] + thread
+                channel_messages.append(message)
+            self.history[channel_id] = channel_messages
+
+    def message_count(self):
+        return sum(len(messages) for messages in self.history.values()) + \
+            sum(len(thread) - 1 for thread in self.replies.values())
+
+
+class RateLimits(object):
+    """sliding one minute window per method, scale multiplies every tier"""
+
+    def __init__(self, scale=1.0, tiers=None):
+        self.limits = {method: max(1, int(rate * scale)) for method, rate in (tiers or RATE_LIMIT_TIERS).items()}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def retry_after(self, method):
+        """record a call, returns 0 if it is allowed or the seconds to wait"""
+        limit = self.limits.get(method)
+        if limit is None:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            calls = self.calls.setdefault(method, deque())
+            while calls and now - calls[0] >= 60:
+                calls.popleft()
+            if len(calls) >= limit:
+                return max(1, int(math.ceil(60 - (now - calls[0]))))
+            calls.append(now)
+            return 0
+
+
+def page(items, cursor, limit):
+    """slice a list by an offset cursor, returns the items and the next cursor ('' on the last page)"""
+    offset = int(cursor or 0)
+    limit = max(1, min(int(limit or 100), 1000))
+    end = offset + limit
+    return items[offset:end], str(end) if end < len(items) else ''
+
+
+class FakeSlackServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, workspace, rate_limits, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeSlackHandler)
+        self.workspace = workspace
+        self.rate_limits = rate_limits
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {'calls': {}, 'rate_limited': {}, 'bytes_sent': 0}
+
+    def count(self, method, rate_limited=False, bytes_sent=0):
+        with self.stats_lock:
+            key = 'rate_limited' if rate_limited else 'calls'
+            self.stats[key][method] = self.stats[key].get(method, 0) + 1
+            self.stats['bytes_sent'] += bytes_sent
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        # slack_export.py downloads https://files.slack.com/<path>?<query> from the host of --filesUrl
+        if not url.path.startswith('/api/'):
+            return self.serve_file(url.path, url.query)
+        method = url.path.rsplit('/', 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if self.command == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            params.update((key, values[0]) for key, values in parse_qs(self.rfile.read(length).decode()).items())
+
+        retry_after = self.server.rate_limits.retry_after(method)
+        if retry_after:
+            self.server.count(method, rate_limited=True)
+            return self.send_body(429, b'', {'Retry-After': str(retry_after)})
+
+        handler = getattr(self, 'api_' + method.replace('.', '_'), None)
+        body = handler(params) if handler else {'ok': False, 'error': 'unknown_method'}
+        data = json.dumps(body).encode()
+        self.server.count(method, bytes_sent=len(data))
+        self.send_body(200, data, {'Content-Type': 'application/json; charset=utf-8'})
+
+    do_POST = do_GET
+
+    def send_body(self, status, data, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def serve_file(self, path, query=''):
+        size, file_query = self.server.workspace.files.get(path, (None, None))
+        if size is None or file_query not in ('', query):
+            return self.send_body(404, b'', {})
+        retry_after = self.server.rate_limits.retry_after('files.slack.com')
+        if retry_after:
+            self.server.count('files.slack.com', rate_limited=True)
+            return self.send_body(429, b'', {'Retry-After': str(retry_after)})
+        start = 0
+        status = 200
+        headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        if self.headers.get('Range', '').startswith('bytes='):
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0] or 0)
+            if start >= size:
+                return self.send_body(416, b'', {'Content-Range': 'bytes */{0}'.format(size)})
+            status = 206
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, size - 1, size)
+        data = b'\0' * (size - start)
+        self.server.count('files.slack.com', bytes_sent=len(data))
+        self.send_body(status, data, headers)
+
+    def api_conversations_list(self, params):
+        workspace = self.server.workspace
+        types = params.get('types', 'public_channel').split(',')
+        channels = workspace.channels if 'public_channel' in types else []
+        channels, cursor = page(channels, params.get('cursor'), params.get('limit'))
+        return {'ok': True, 'channels': channels, 'response_metadata': {'next_cursor': cursor}}
+
+    def api_conversations_history(self, params):
+        messages = self.server.workspace.history.get(params.get('channel'))
+        if messages is None:
+            return {'ok': False, 'error': 'channel_not_found'}
+        oldest = float(params.get('oldest') or 0)
+        latest = float(params.get('latest') or 'inf')
+        inclusive = params.get('inclusive') in ('1', 'true')
+        selected = [message for message in reversed(messages)
+                    if (oldest <= float(message['ts']) <= latest if inclusive
+                        else oldest < float(message['ts']) < latest)]
+        selected, cursor = page(selected, params.get('cursor'), params.get('limit'))
+        return {'ok': True, 'messages': selected, 'has_more': cursor != '',
+                'response_metadata': {'next_cursor': cursor}}
+
+    def api_conversations_replies(self, params):
+        thread = self.server.workspace.replies.get((params.get('channel'), params.get('ts')))
+        if thread is None:
+            return {'ok': False, 'error': 'thread_not_found'}
+        replies, cursor = page(thread[1:], params.get('cursor'), params.get('limit'))
+        # like Slack, every page starts with the parent message
+        return {'ok': True, 'messages': [thread[0]] + replies, 'has_more': cursor != '',
+                'response_metadata': {'next_cursor': cursor}}
+
+    def api_users_list(self, params):
+        members, cursor = page(self.server.workspace.users, params.get('cursor'), params.get('limit'))
+        return {'ok': True, 'members': members, 'response_metadata': {'next_cursor': cursor}}
+
+    def api_users_info(self, params):
+        for user in self.server.workspace.users:
+            if user['id'] == params.get('user'):
+                return {'ok': True, 'user': user}
+        return {'ok': False, 'error': 'user_not_found'}
+
+
+def add_workspace_arguments(parser):
+    parser.add_argument('--channels', type=int, default=10, help="Number of channels")
+    parser.add_argument('--messages', type=int, default=1000, help="Top-level messages per channel")
+    parser.add_argument('--threadDensity', type=float, default=0.1, help="Share of messages starting a thread")
+    parser.add_argument('--replies', type=int, default=5, help="Replies per thread")
+    parser.add_argument('--fileDensity', type=float, default=0.02, help="Share of messages with an attachment")
+    parser.add_argument('--fileSize', type=int, default=64 * 1024, help="Attachment size in bytes")
+    parser.add_argument('--users', type=int, default=1000, help="Members of the workspace")
+    parser.add_argument('--imported', type=int, default=0,
+                        help="Messages per channel older than the channel's creation, like in an imported channel")
+    parser.add_argument('--rateScale', type=float, default=1.0,
+                        help="Factor applied to the rate limit tiers, e.g. 100 for a quick run")
+
+
+def workspace_from_args(args):
+    return Workspace(args.channels, args.messages, args.threadDensity, args.replies, args.fileDensity,
+                     args.fileSize, args.users, imported=args.imported)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline Slack API stand-in')
+    add_workspace_arguments(parser)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    server = FakeSlackServer(workspace_from_args(args), RateLimits(args.rateScale), ('127.0.0.1', args.port))
+    print("Serving {0} messages in {1} channels on {2}/api/".format(server.workspace.message_count(),
+                                                                    args.channels, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats, indent=4))
@@ -0,0 +1,142 @@
+"""
+End-to-end throughput benchmark against the offline stand-in in fake_slack.py.
+
+Starts the stand-in on a synthetic workspace and runs two scenarios, each in its own process:
+  adapter  SlackApiAdapter.get_conversations + get_channel_history for every channel + get_users
+  export   slack_export.py --publicChannels with the given extra arguments
+
+and reports messages/sec, peak RSS, API calls, 429 responses, time spent throttled and, for the export, the time
+spent writing JSON taken from its metrics file, e.g.
+
+    python bench/run_benchmark.py --channels 20 --messages 2000 --rateScale 100 --exportArgs="--stream"
+
+--checkShards N makes the adapter scenario fetch every channel a second time in N time windows and fail if that
+history differs from the one fetched page by page, e.g. with --imported 50 for messages older than the channels.
+"""
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIRECTORY = os.path.dirname(BENCH_DIRECTORY)
+sys.path.insert(0, ROOT_DIRECTORY)
+
+import fake_slack  # noqa: E402
+
+SCENARIOS = ('adapter', 'export')
+
+
+def drive_adapter(api_url, rate_scale, check_shards=0):
+    """run in a child process: export every channel through SlackApiAdapter and print the results as JSON"""
+    import SlackApiAdapter
+
+    slack = SlackApiAdapter.SlackApiAdapter(token='xoxc-bench', headers={'cookie': 'bench'}, api_url=api_url,
+                                            rate_limiter=SlackApiAdapter.RateLimiter(scale=rate_scale))
+    messages = 0
+    for channel in slack.get_conversations('public_channel'):
+        channel_messages, users = slack.get_channel_history(channel['id'])
+        messages += len(channel_messages)
+        if check_shards > 1:
+            sharded, sharded_users = slack.get_channel_history(channel['id'], shards=check_shards,
+                                                               created=channel['created'])
+            if sharded != channel_messages or sharded_users != users:
+                raise RuntimeError("{0} fetched in {1} windows has {2} messages instead of {3}".format(
+                    channel['id'], check_shards, len(sharded), len(channel_messages)))
+    slack.get_users()
+    slack.close()
+    print(json.dumps({'messages': messages,
+                      'throttled_seconds': slack.rate_limiter.throttled_seconds}))
+
+
+def run_child(command, cwd):
+    """run a command, returns its stdout, wall time and peak RSS in MB"""
+    started = time.monotonic()
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(command, cwd=cwd, stdout=output, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - started
+        output.seek(0)
+        stdout = output.read().decode(errors='replace')
+    if process.returncode:
+        raise RuntimeError("{0} failed:\n{1}".format(' '.join(command), stdout[-2000:]))
+    # ru_maxrss is in KB on Linux
+    return stdout, wall, rusage.ru_maxrss / 1024.0
+
+
+def run_scenario(name, server, args):
+    server.reset_stats()
+    with tempfile.TemporaryDirectory() as work_directory:
+        if name == 'adapter':
+            command = [sys.executable, os.path.abspath(__file__), '--driveAdapter', server.url + '/api/',
+                       '--rateScale', str(args.rateScale), '--checkShards', str(args.checkShards)]
+            stdout, wall, rss = run_child(command, work_directory)
+            throttled = json.loads(stdout.strip().splitlines()[-1])['throttled_seconds']
+            json_seconds = None
+        else:
+            command = [sys.executable, os.path.join(ROOT_DIRECTORY, 'slack_export.py'),
+                       '--token', 'xoxc-bench', '--cookie', 'bench', '--publicChannels',
+                       '--apiUrl', server.url + '/api/', '--filesUrl', server.url,
+                       '--rateLimitScale', str(args.rateScale)] + shlex.split(args.exportArgs)
+            stdout, wall, rss = run_child(command, work_directory)
+            with open(os.path.join(work_directory, 'dump_metrics.json')) as in_file:
+                metrics = json.load(in_file)
+            throttled = sum(method['throttled_seconds'] for method in metrics['methods'].values())
+            json_seconds = metrics['json_dump']['seconds']
+
+    stats = server.stats
+    return {
+        'scenario': name,
+        'seconds': round(wall, 2),
+        'messages_per_second': round(server.workspace.message_count() / wall, 1),
+        'peak_rss_mb': round(rss, 1),
+        'api_calls': sum(stats['calls'].values()),
+        'calls_per_method': dict(stats['calls']),
+        'rate_limited': sum(stats['rate_limited'].values()),
+        'throttled_seconds': throttled,
+        'json_dump_seconds': json_seconds,
+    }
+
+
+def print_results(results):
+    print("{0:<10}{1:>10}{2:>12}{3:>12}{4:>11}{5:>7}{6:>12}{7:>8}".format(
+        'scenario', 'seconds', 'messages/s', 'peak RSS MB', 'API calls', '429s', 'throttled s', 'JSON s'))
+    for result in results:
+        print("{scenario:<10}{seconds:>10}{messages_per_second:>12}{peak_rss_mb:>12}{api_calls:>11}"
+              "{rate_limited:>7}{throttled:>12}{json:>8}".format(
+                  throttled=round(result['throttled_seconds'], 1),
+                  json='-' if result['json_dump_seconds'] is None else round(result['json_dump_seconds'], 2),
+                  **result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark slack-export against an offline Slack stand-in')
+    fake_slack.add_workspace_arguments(parser)
+    parser.add_argument('--scenarios', nargs='*', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--exportArgs', default='',
+                        help="Extra arguments for slack_export.py, e.g. --exportArgs=\"--stream --workers 8\"")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results to a JSON file")
+    parser.add_argument('--checkShards', type=int, default=0, metavar='N',
+                        help="Also fetch every channel in N time windows in the adapter scenario and compare")
+    parser.add_argument('--driveAdapter', metavar='API_URL', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.driveAdapter:
+        drive_adapter(args.driveAdapter, args.rateScale, args.checkShards)
+        sys.exit()
+
+    workspace = fake_slack.workspace_from_args(args)
+    server = fake_slack.FakeSlackServer(workspace, fake_slack.RateLimits(args.rateScale)).start()
+    print("Benchmarking against {0} messages in {1} channels".format(workspace.message_count(), args.channels))
+    results = [run_scenario(name, server, args) for name in args.scenarios]
+    server.shutdown()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as out_file:
+            json.dump(results, out_file, indent=4)
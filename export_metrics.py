@@ -0,0 +1,191 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+# from Python 3.12 on a profile sees the calls of every thread, and only one can be active at a time
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+
+class ExportMetrics(object):
+    """
+    Counters of a running export, safe to update from many threads:
+    per API method call counts, latency histograms, 429s, time spent throttled and bytes received,
+    per conversation page and message counts, and the time spent encoding and writing JSON files.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.methods = {}
+        self.conversations = {}
+        self.json_dump = {'files': 0, 'seconds': 0.0}
+
+    def _method(self, method):
+        if method not in self.methods:
+            self.methods[method] = {
+                'calls': 0,
+                'seconds': 0.0,
+                'latency_buckets': [0] * len(LATENCY_BUCKETS),
+                'rate_limited': 0,
+                'throttled_seconds': 0.0,
+                'bytes_received': 0,
+            }
+        return self.methods[method]
+
+    def _conversation(self, conversation_id):
+        return self.conversations.setdefault(conversation_id, {'pages': 0, 'messages': 0})
+
+    def record_request(self, method, seconds, bytes_received):
+        with self.lock:
+            stats = self._method(method)
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['bytes_received'] += bytes_received
+            for bucket, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats['latency_buckets'][bucket] += 1
+                    break
+
+    def record_bytes(self, method, bytes_received):
+        with self.lock:
+            self._method(method)['bytes_received'] += bytes_received
+
+    def record_rate_limited(self, method):
+        with self.lock:
+            self._method(method)['rate_limited'] += 1
+
+    def record_throttled(self, method, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self._method(method)['throttled_seconds'] += seconds
+
+    def record_page(self, conversation_id):
+        with self.lock:
+            self._conversation(conversation_id)['pages'] += 1
+
+    def record_messages(self, conversation_id, count):
+        with self.lock:
+            self._conversation(conversation_id)['messages'] += count
+
+    @contextmanager
+    def time_json_dump(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_json_dump(1, time.perf_counter() - started)
+
+    def record_json_dump(self, files, seconds):
+        with self.lock:
+            self.json_dump['files'] += files
+            self.json_dump['seconds'] += seconds
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'latency_buckets': [str(upper_bound) for upper_bound in LATENCY_BUCKETS],
+                'methods': json.loads(json.dumps(self.methods)),
+                'conversations': dict((key, dict(value)) for key, value in self.conversations.items()),
+                'json_dump': dict(self.json_dump),
+            }
+
+    def write_json(self, file_name):
+        data = self.to_dict()
+        with open(file_name + '.tmp', 'w') as out_file:
+            json.dump(data, out_file, indent=4, sort_keys=True)
+        os.replace(file_name + '.tmp', file_name)
+
+    def write_prometheus(self, file_name):
+        """write the metrics in the Prometheus text format, for node_exporter's textfile collector"""
+        data = self.to_dict()
+        lines = [
+            '# TYPE slack_export_api_requests_total counter',
+            '# TYPE slack_export_api_request_seconds histogram',
+            '# TYPE slack_export_api_rate_limited_total counter',
+            '# TYPE slack_export_api_throttled_seconds_total counter',
+            '# TYPE slack_export_api_received_bytes_total counter',
+        ]
+        for method, stats in sorted(data['methods'].items()):
+            label = 'method="{0}"'.format(method)
+            lines.append('slack_export_api_requests_total{{{0}}} {1}'.format(label, stats['calls']))
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, stats['latency_buckets']):
+                cumulative += count
+                le = '+Inf' if upper_bound == float('inf') else upper_bound
+                lines.append('slack_export_api_request_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                    label, le, cumulative))
+            lines.append('slack_export_api_request_seconds_sum{{{0}}} {1}'.format(label, stats['seconds']))
+            lines.append('slack_export_api_request_seconds_count{{{0}}} {1}'.format(label, stats['calls']))
+            lines.append('slack_export_api_rate_limited_total{{{0}}} {1}'.format(label, stats['rate_limited']))
+            lines.append('slack_export_api_throttled_seconds_total{{{0}}} {1}'.format(
+                label, stats['throttled_seconds']))
+            lines.append('slack_export_api_received_bytes_total{{{0}}} {1}'.format(label, stats['bytes_received']))
+        lines.append('# TYPE slack_export_json_dump_seconds_total counter')
+        lines.append('slack_export_json_dump_seconds_total {0}'.format(data['json_dump']['seconds']))
+        lines.append('# TYPE slack_export_json_files_total counter')
+        lines.append('slack_export_json_files_total {0}'.format(data['json_dump']['files']))
+        lines.append('# TYPE slack_export_messages_total counter')
+        lines.append('slack_export_messages_total {0}'.format(
+            sum(conversation['messages'] for conversation in data['conversations'].values())))
+        lines.append('# TYPE slack_export_duration_seconds gauge')
+        lines.append('slack_export_duration_seconds {0}'.format(data['seconds']))
+        with open(file_name + '.tmp', 'w') as out_file:
+            out_file.write('\n'.join(lines) + '\n')
+        os.replace(file_name + '.tmp', file_name)
+
+
+class Profiler(object):
+    """
+    cProfile across threads. Up to Python 3.11 a profile only sees the thread that enabled it, every thread gets a
+    profile of its own that runcall enables around the calls it makes, they are merged when dumped. From 3.12 on one
+    profile, enabled when the Profiler is created, sees the whole process and runcall only calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.local = threading.local()
+        if PROCESS_WIDE_PROFILE:
+            self.profiles.append(cProfile.Profile())
+            self.profiles[0].enable()
+
+    def runcall(self, func, *args, **kwargs):
+        # a call made from within a profiled call is profiled already
+        if PROCESS_WIDE_PROFILE or getattr(self.local, 'running', False):
+            return func(*args, **kwargs)
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        self.local.running = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.local.running = False
+
+    def wrap(self, func):
+        """func run under the profiler, for the tasks of a thread pool"""
+        return functools.partial(self.runcall, func)
+
+    def dump(self, file_name):
+        with self.lock:
+            if PROCESS_WIDE_PROFILE and self.profiles:
+                self.profiles[0].disable()
+            if not self.profiles:
+                return
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+        stats.dump_stats(file_name)
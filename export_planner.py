@@ -0,0 +1,182 @@
+"""
+Dry run of an export: one conversations.history request per conversation samples the newest page, from which the
+size of the whole history, its threads and files are extrapolated. The plan estimates the API calls per method, the
+time the rate limits need for them and the size of the output, and lists the conversations biggest first, the
+order in which an export run with --usePlan starts them.
+"""
+import json
+import math
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import json_backend
+
+# messages per conversations.history and conversations.replies page, as requested by SlackApiAdapter
+PAGE_SIZE = 1000
+# zlib level of the zip output by default
+ZIP_LEVEL = 6
+
+
+def estimate_conversation(channel, messages, has_more, oldest=0, exclude_threads=False):
+    """
+    extrapolate the history of a conversation from its newest page, assuming messages came at the same rate since
+    the conversation was created (or since oldest)
+    Args:
+        messages: the newest page of the history, newest message first
+        has_more: whether the history has more pages
+    """
+    count = len(messages)
+    total = count
+    if has_more and count > 1:
+        newest = float(messages[0]['ts'])
+        start = max(float(oldest or 0), float(channel.get('created') or 0))
+        span = max(newest - float(messages[-1]['ts']), 1.0)
+        total = max(count + 1, int(count * (newest - start) / span))
+    scale = total / count if count else 0
+
+    threads = [message for message in messages if message.get('reply_count')]
+    replies = sum(message['reply_count'] for message in threads)
+    reply_pages = sum(math.ceil(message['reply_count'] / PAGE_SIZE) for message in threads)
+    files = sum(len(message.get('files', ())) for message in messages)
+    if exclude_threads:
+        replies = reply_pages = 0
+    # replies are assumed to be as big as the messages of the sample
+    sample = json.dumps(messages, indent=4).encode() if messages else b''
+    zip_bytes = len(zlib.compress(sample, ZIP_LEVEL)) if messages else 0
+    compact_bytes = len(json_backend.dumps_compact(messages)) if messages else 0
+    exported = total + replies * scale
+    per_message = 1.0 / count if count else 0
+
+    return {
+        'id': channel['id'],
+        'name': channel.get('name', channel['id']),
+        'messages': int(total),
+        'threads': int(len(threads) * scale),
+        'replies': int(replies * scale),
+        'files': int(files * scale),
+        'api_calls': {
+            'conversations.history': max(1, math.ceil(total / PAGE_SIZE)),
+            'conversations.replies': int(math.ceil(reply_pages * scale)),
+        },
+        'output_bytes': {
+            'json': int(len(sample) * per_message * exported),
+            'compact_json': int(compact_bytes * per_message * exported),
+            'zip': int(zip_bytes * per_message * exported),
+        },
+        'users': sorted(set(message['user'] for message in messages if message.get('user'))),
+    }
+
+
+def rate_limited_seconds(rate_limiter, method, calls):
+    """the least time the rate limiter lets the calls through in, the first burst goes out at once"""
+    return max(0, calls - rate_limiter.burst) * 60.0 / rate_limiter.rate(method)
+
+
+def plan_export(slack, conversations, exclude_threads=False, state=None, workers=1, list_calls=0):
+    """
+    Sample every conversation and estimate the export
+    Args:
+        slack: SlackApiAdapter.SlackApiAdapter
+        conversations: list of (conversation, directory, room type, description) tuples
+        state: high-water marks of an --incremental run, only newer messages are estimated
+        workers: number of conversations sampled at the same time
+        list_calls: conversations.list requests made to find the conversations
+    """
+    def sample(conversation):
+        channel = conversation[0]
+        oldest = state.get(channel['id'], 0) if state is not None else 0
+        messages, has_more = slack.get_history_page(channel['id'], oldest=oldest)
+        estimate = estimate_conversation(channel, messages, has_more, oldest, exclude_threads)
+        estimate['description'] = conversation[3]
+        return estimate
+
+    print("Sampling the history of {0} conversations".format(len(conversations)))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        estimates = list(executor.map(sample, conversations))
+    # the longest conversations first, so they don't start last and hold up the end of the export
+    estimates.sort(key=lambda estimate: (estimate['api_calls']['conversations.history'] +
+                                         estimate['api_calls']['conversations.replies'], estimate['messages']),
+                   reverse=True)
+
+    users = set()
+    calls = {'conversations.list': list_calls, 'conversations.history': 0, 'conversations.replies': 0}
+    output_bytes = {'json': 0, 'compact_json': 0, 'zip': 0}
+    files = 0
+    for estimate in estimates:
+        users.update(estimate.pop('users'))
+        files += estimate['files']
+        for method, count in estimate['api_calls'].items():
+            calls[method] += count
+        for output, size in estimate['output_bytes'].items():
+            output_bytes[output] += size
+    # at least the authors seen in the samples, looked up with users.info
+    calls['users.info'] = len(users)
+    calls['files.slack.com'] = files
+
+    rate_limiter = slack.rate_limiter
+    seconds = {method: rate_limited_seconds(rate_limiter, method, count) for method, count in calls.items()}
+    # history and replies have buckets of their own and are fetched at the same time, users and files come after
+    total_seconds = (max(seconds['conversations.history'], seconds['conversations.replies']) +
+                     seconds['users.info'])
+    return {
+        'created': time.time(),
+        'rate_limit_scale': rate_limiter.scale,
+        'totals': {
+            'conversations': len(estimates),
+            'messages': sum(estimate['messages'] + estimate['replies'] for estimate in estimates),
+            'files': files,
+            'api_calls': calls,
+            'rate_limited_seconds': seconds,
+            'estimated_seconds': total_seconds,
+            'estimated_seconds_with_files': total_seconds + seconds['files.slack.com'],
+            'output_bytes': output_bytes,
+        },
+        'conversations': estimates,
+    }
+
+
+def write_plan(file_name, plan):
+    with open(file_name, 'w') as out_file:
+        json.dump(plan, out_file, indent=4)
+
+
+def load_plan_order(file_name):
+    """the conversation ids of a plan in the order they are started"""
+    with open(file_name) as in_file:
+        return [conversation['id'] for conversation in json.load(in_file)['conversations']]
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} TB'.format(size)
+
+
+def format_duration(seconds):
+    if seconds < 3600:
+        return '{0:d}m {1:02d}s'.format(int(seconds // 60), int(seconds % 60))
+    return '{0:d}h {1:02d}m'.format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+
+def print_plan(plan, top=10):
+    totals = plan['totals']
+    print("{0:<30}{1:>12}{2:>10}{3:>12}".format('conversation', 'messages', 'threads', 'API calls'))
+    for estimate in plan['conversations'][:top]:
+        print(u"{0:<30}{1:>12}{2:>10}{3:>12}".format(estimate['name'][:29], estimate['messages'],
+                                                     estimate['threads'], sum(estimate['api_calls'].values())))
+    if len(plan['conversations']) > top:
+        print("... and {0} more conversations".format(len(plan['conversations']) - top))
+    print("")
+    print("Estimated messages: {0} in {1} conversations, {2} files".format(
+        totals['messages'], totals['conversations'], totals['files']))
+    for method, calls in sorted(totals['api_calls'].items()):
+        print("  {0:<24}{1:>8} calls, {2} under the rate limits".format(
+            method, calls, format_duration(totals['rate_limited_seconds'][method])))
+    print("Estimated time: {0}, {1} with --downloadSlackFiles".format(
+        format_duration(totals['estimated_seconds']), format_duration(totals['estimated_seconds_with_files'])))
+    print("Estimated output: {0} of JSON, {1} with --compactJson, {2} zipped".format(
+        format_size(totals['output_bytes']['json']), format_size(totals['output_bytes']['compact_json']),
+        format_size(totals['output_bytes']['zip'])))
@@ -0,0 +1,32 @@
+"""
+JSON decoding of the API responses and encoding of the compact dump files.
+orjson (pip install orjson) is used when it is installed, the json module otherwise.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """decode a str or bytes document"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson refuses lone surrogates (e.g. "\ud83d") which json accepts, let json raise real errors
+            pass
+    return json.loads(data)
+
+
+def dumps_compact(data):
+    """encode to UTF-8 bytes without any whitespace"""
+    try:
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except (TypeError, UnicodeEncodeError):
+        # strings with lone surrogates can't be encoded as UTF-8, json escapes them
+        return json.dumps(data, separators=(',', ':')).encode('ascii')
@@ -0,0 +1,59 @@
+import json_backend
+import sqlite_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    channel_id TEXT NOT NULL,
+    thread_ts TEXT NOT NULL,
+    latest_reply TEXT,
+    reply_count INTEGER,
+    replies TEXT,
+    projection TEXT,
+    PRIMARY KEY (channel_id, thread_ts)
+)
+"""
+
+
+class ReplyCache(sqlite_store.SqliteDatabase):
+    """
+    On-disk cache of the replies of every fetched thread, keyed by (channel id, thread_ts).
+    A thread is served from the cache as long as its parent still has the 'latest_reply' and 'reply_count' that
+    were seen when it was fetched. Edits of replies don't change either, they are only picked up by a fresh cache.
+    Args:
+        projection: FieldProjection.key() of the replies that are put, threads cached with other fields are misses
+    """
+
+    def __init__(self, file_name, projection=''):
+        super().__init__(file_name)
+        self.projection = projection
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        with self.lock, self.connection:
+            self.connection.execute(SCHEMA)
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(threads)')]
+            # caches written before the projection was recorded, their threads are fetched again
+            if 'projection' not in columns:
+                self.connection.execute('ALTER TABLE threads ADD COLUMN projection TEXT')
+
+    def get(self, channel_id, parent):
+        """the cached replies of a thread parent, None if the thread isn't cached or has changed since"""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT latest_reply, reply_count, replies, projection FROM threads '
+                'WHERE channel_id = ? AND thread_ts = ?', (channel_id, parent['thread_ts'])).fetchone()
+            if row is None or row[0] != parent.get('latest_reply') or row[1] != parent.get('reply_count') or \
+                    row[3] != self.projection:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json_backend.loads(row[2])
+
+    def put(self, channel_id, parent, replies):
+        data = json_backend.dumps_compact(replies).decode('utf-8')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO threads '
+                '(channel_id, thread_ts, latest_reply, reply_count, replies, projection) VALUES (?, ?, ?, ?, ?, ?)',
+                (channel_id, parent['thread_ts'], parent.get('latest_reply'), parent.get('reply_count'), data,
+                 self.projection))
@@ -1,30 +1,87 @@
 import argparse
+import itertools
 import json
+import multiprocessing
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 import shutil
+import sys
+import threading
+import time
+import zipfile
 import requests
 from urllib.parse import urlparse
 
 import SlackApiAdapter
+import export_metrics
+import export_planner
+import json_backend
+import reply_cache
+import sqlite_store
+import user_resolver
 
 OUTPUT_DIRECTORY = 'dump'
+# newest exported 'ts' per conversation id, kept next to the dump for --incremental runs
+STATE_FILE = 'dump_state.json'
+# number of conversations exported at the same time
+DEFAULT_WORKERS = 4
+FILES_HOST = 'files.slack.com'
+# number of files downloaded at the same time
+DEFAULT_DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# days of a streamed conversation kept in memory before they're written out
+DEFAULT_OPEN_DAYS = 8
+# progress of the running export, kept next to the dump for --resume
+JOURNAL_FILE = 'dump_journal.json'
+# pages of a streamed conversation between two journal checkpoints
+CHECKPOINT_PAGES = 10
+# counters of the export written next to the dump, see export_metrics.py
+METRICS_FILE = 'dump_metrics.json'
 
+# collects the metrics of every export run by this process
+metrics = export_metrics.ExportMetrics()
 
-def dump_file(list_to_dump, type):
+
+def write_json_file(file_name, data, compact=False, **kwargs):
+    """
+    write through a temporary file which replaces file_name, an interrupted export never leaves half a file
+    Args:
+        compact: write UTF-8 without whitespace through json_backend, kwargs are for json.dump otherwise
+    """
+    temp_file_name = file_name + '.tmp'
+    if compact:
+        with open(temp_file_name, 'wb') as out_file, metrics.time_json_dump():
+            out_file.write(json_backend.dumps_compact(data))
+    else:
+        with open(temp_file_name, 'w') as out_file, metrics.time_json_dump():
+            json.dump(data, out_file, **kwargs)
+    os.replace(temp_file_name, file_name)
+
+
+def write_export_file(file_name, data, compact=False):
+    """write a file of the dump, indented for people unless it's compact"""
+    if compact:
+        write_json_file(file_name, data, compact=True)
+    else:
+        write_json_file(file_name, data, indent=4)
+
+
+def dump_file(list_to_dump, type, compact=False):
     file_names = {
         'private_channels': 'groups.json',
         'public_channels': 'channels.json',
         'im': 'dms.json'
     }
     file_name = file_names.get(type, f'{type}.json')
-    with open(file_name, 'w') as outFile:
-        json.dump(list_to_dump, outFile, indent=4)
+    write_export_file(file_name, list_to_dump, compact)
 
 
 def mkdir(directory):
     if not os.path.isdir(directory):
-        os.makedirs(directory)
+        # workers may create the same directory concurrently
+        os.makedirs(directory, exist_ok=True)
 
 
 def parse_time_stamp(time_stamp):
@@ -48,105 +105,741 @@ def channel_rename(old_room_name, new_room_name):
     os.rmdir(old_room_name)
 
 
-def write_message_file(file_name, messages):
-    directory = os.path.dirname(file_name)
+def load_state(file_name):
+    """read the per-conversation high-water marks written by a previous --incremental run"""
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name) as in_file:
+        return json.load(in_file)
+
 
+def save_state(file_name, state):
+    write_json_file(file_name, state, indent=4, sort_keys=True)
+
+
+def newest_time_stamp(messages):
+    """return the newest 'ts' of the top-level messages, thread replies don't move the high-water mark"""
+    top_level = [message['ts'] for message in messages if message.get('thread_ts', message['ts']) == message['ts']]
+    if not top_level:
+        return None
+    return max(top_level, key=float)
+
+
+def newer_time_stamp(time_stamp, other):
+    """the newer of two 'ts', either may be None"""
+    if time_stamp is None or (other is not None and float(other) > float(time_stamp)):
+        return other
+    return time_stamp
+
+
+def merge_messages(old_messages, new_messages):
+    """merge two lists of messages by 'ts', new messages replace old ones with the same 'ts'"""
+    merged = {message['ts']: message for message in old_messages}
+    merged.update((message['ts'], message) for message in new_messages)
+    return sorted(merged.values(), key=lambda t: t['ts'])
+
+
+def write_message_file(file_name, messages, merge=False, compact=False):
+    """write a day file, its directory has to exist"""
     # if there's no data to write to the file, return
     if not messages:
         return
 
-    if not os.path.isdir(directory):
-        mkdir(directory)
+    # on incremental runs the day may already have been exported
+    if merge and os.path.exists(file_name):
+        with open(file_name, 'rb') as in_file:
+            messages = merge_messages(json_backend.loads(in_file.read()), messages)
+
+    write_export_file(file_name, messages, compact)
+
+
+def write_day_file(file_name, messages, merge=False, compact=False):
+    """write_message_file in a worker process, returns the files and seconds of JSON writing it took"""
+    files, seconds = metrics.json_dump['files'], metrics.json_dump['seconds']
+    write_message_file(file_name, messages, merge, compact)
+    return metrics.json_dump['files'] - files, metrics.json_dump['seconds'] - seconds
+
+
+class FileWriterPool(object):
+    """
+    Encode and write day files on a pool of workers while the export goes on.
+    Args:
+        workers: number of day files written at the same time, 0 writes them on the calling thread
+        processes: encode in worker processes instead of threads, the json module encodes indented output in pure
+                   Python so only processes encode more than one file at a time
+        profiler: export_metrics.Profiler the writer threads run under, processes aren't profiled
+    """
+
+    def __init__(self, workers=0, processes=False, profiler=None):
+        self.processes = processes
+        self.executor = None
+        self.write = write_message_file if profiler is None else profiler.wrap(write_message_file)
+        if workers and processes:
+            # the export runs many threads, a forked worker could inherit a lock one of them holds
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        elif workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='writer')
+
+    def submit(self, file_name, messages, merge=False, compact=False):
+        """
+        write a day file, messages mustn't change until it is written
+        Returns:
+            future of the write, None if it was written already
+        """
+        if self.executor is None:
+            write_message_file(file_name, messages, merge, compact)
+            return None
+        if not self.processes:
+            return self.executor.submit(self.write, file_name, messages, merge, compact)
+        future = self.executor.submit(write_day_file, file_name, messages, merge, compact)
+        future.add_done_callback(self._record)
+        return future
+
+    @staticmethod
+    def _record(future):
+        if not future.cancelled() and future.exception() is None:
+            metrics.record_json_dump(*future.result())
+
+    @staticmethod
+    def wait(futures):
+        """wait for the writes, raises the first error"""
+        for future in futures:
+            if future is not None:
+                future.result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class DownloadManifest(object):
+    """
+    Files on files.slack.com referenced by the exported messages, collected before the day files are written.
+    The links in the messages are replaced with local ones, suitable for use with slack-export-viewer
+    if files.slack.com is linked.
+    """
+
+    def __init__(self):
+        # local file -> (url, expected size)
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
 
-    with open(file_name, 'w') as out_file:
-        json.dump(messages, out_file, indent=4)
+    def collect(self, message):
+        for slackFile in message.get("files", []):
+            # Skip deleted files
+            if slackFile.get("mode") == "tombstone":
+                continue
+
+            for key, value in slackFile.items():
+                # Find all entries referring to files on files.slack.com
+                if not isinstance(value, str) or not value.startswith("https://files.slack.com/"):
+                    continue
+
+                url = urlparse(value)
+
+                localFile = os.path.join("../files.slack.com",
+                                         url.path[1:])  # Need to discard first "/" in URL, because:
+                # "If a component is an absolute path, all previous components are thrown away and joining continues
+                # from the absolute path component."
+                with self.lock:
+                    self.files.setdefault(localFile, (url.geturl(), slackFile.get("size", -1)))
+
+                slackFile[key] = "/static/files.slack.com%s" % url.path
+
+
+class ExportJournal(object):
+    """
+    Progress of a running export, saved next to the dump so an interrupted export can continue with --resume.
+    Conversations are recorded when they are finished, streamed ones also every few pages together with the
+    history cursor ('latest') up to which their day files are complete.
+    """
 
+    def __init__(self, file_name, manifest=None):
+        self.file_name = file_name
+        self.manifest = manifest
+        # conversation id -> {'newest': ts, 'users': [...]}
+        self.finished = {}
+        # conversation id -> {'latest': ts, 'newest': ts, 'users': [...]}
+        self.in_progress = {}
+        self.lock = threading.Lock()
 
-def parse_messages(room_dir, messages, room_type):
-    name_change_flag = room_type + "_name"
+    @classmethod
+    def load(cls, file_name, manifest=None):
+        journal = cls(file_name, manifest)
+        if os.path.exists(file_name):
+            with open(file_name) as in_file:
+                data = json.load(in_file)
+            journal.finished = data['finished']
+            journal.in_progress = data['in_progress']
+            if manifest is not None:
+                manifest.files.update((local_file, tuple(download)) for local_file, download in data['files'])
+        return journal
 
-    current_file_date = ''
-    current_messages = []
-    for message in messages:
-        # first store the date of the next message
-        ts = parse_time_stamp(message['ts'])
-        file_date = '{:%Y-%m-%d}'.format(ts)
+    def checkpoint(self, conversation_id, latest, newest, users):
+        with self.lock:
+            self.in_progress[conversation_id] = {'latest': latest, 'newest': newest, 'users': list(users)}
+            self._save()
 
-        # if it's on a different day, write out the previous day's messages
-        if file_date != current_file_date:
-            out_file_name = u'{room}/{file}.json'.format(room=room_dir, file=current_file_date)
-            write_message_file(out_file_name, current_messages)
-            current_file_date = file_date
-            current_messages = []
+    def finish(self, conversation_id, newest, users):
+        with self.lock:
+            self.in_progress.pop(conversation_id, None)
+            self.finished[conversation_id] = {'newest': newest, 'users': list(users)}
+            self._save()
 
-        # check if current message is a name change
+    def _save(self):
+        files = []
+        if self.manifest is not None:
+            with self.manifest.lock:
+                files = list(self.manifest.files.items())
+        write_json_file(self.file_name, {
+            'finished': self.finished,
+            'in_progress': self.in_progress,
+            'files': files
+        })
+
+    def remove(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+def resolve_room_dirs(conversations):
+    """
+    Move the directories a previous export wrote under earlier names of the conversations ('previous_names' in
+    conversations.list) to their current names, before anything is exported. A directory that is the current one
+    of another conversation is never moved.
+    Args:
+        conversations: list of (conversation, directory, room type, description) tuples
+    """
+    current = set(channel_dir for channel, channel_dir, room_type, description in conversations)
+    for channel, channel_dir, room_type, description in conversations:
         # dms won't have name change events
-        if room_type != "im" and ('subtype' in message) and message['subtype'] == name_change_flag:
-            room_dir = message['name']
-            old_room_path = message['old_name']
-            newRoomPath = room_dir
-            channel_rename(old_room_path, newRoomPath)
+        if room_type == "im":
+            continue
+        for old_name in channel.get('previous_names') or ():
+            if old_name not in current:
+                channel_rename(old_name, channel_dir)
+
+
+def day_of(message):
+    return '{:%Y-%m-%d}'.format(parse_time_stamp(message['ts']))
+
+
+def parse_messages(room_dir, messages, merge=False, manifest=None, compact=False, writer_pool=None):
+    """
+    write sorted messages as per-day files into room_dir, the directory of the current name of the conversation
+    Args:
+        writer_pool: FileWriterPool encoding the day files, None writes them one after the other
+    """
+    writer_pool = writer_pool or FileWriterPool()
+
+    futures = []
+    for file_date, day_messages in itertools.groupby(messages, key=day_of):
+        day_messages = list(day_messages)
+        if manifest is not None:
+            for message in day_messages:
+                manifest.collect(message)
+        out_file_name = u'{room}/{file}.json'.format(room=room_dir, file=file_date)
+        futures.append(writer_pool.submit(out_file_name, day_messages, merge, compact))
+    writer_pool.wait(futures)
+
+
+class DayFileWriter(object):
+    """
+    Sort streamed messages into per-day buckets and write them out as day files.
+    At most max_open_days buckets are held in memory, the least recently used one is written out when another day
+    starts. A day that comes back later (e.g. a late thread reply) is merged into the file written before.
+    Messages are written to room_dir, which has to be the current name of the channel, rename events don't move
+    anything.
+    """
+
+    def __init__(self, room_dir, merge=False, max_open_days=DEFAULT_OPEN_DAYS, manifest=None, compact=False,
+                 writer_pool=None):
+        self.room_dir = room_dir
+        self.merge = merge
+        self.compact = compact
+        self.max_open_days = max_open_days
+        self.manifest = manifest
+        self.writer_pool = writer_pool or FileWriterPool()
+        self.buckets = OrderedDict()
+        self.written = set()
+        # day -> write in progress
+        self.pending = {}
+
+    def add(self, message):
+        if self.manifest is not None:
+            self.manifest.collect(message)
+        file_date = day_of(message)
+        bucket = self.buckets.get(file_date)
+        if bucket is None:
+            bucket = self.buckets[file_date] = []
+            if len(self.buckets) > self.max_open_days:
+                self.flush(next(iter(self.buckets)))
+        else:
+            self.buckets.move_to_end(file_date)
+        bucket.append(message)
+
+    def flush(self, file_date):
+        messages = self.buckets.pop(file_date)
+        out_file_name = u'{room}/{file}.json'.format(room=self.room_dir, file=file_date)
+        # a day that comes back is merged into the file once its previous write is finished
+        self.writer_pool.wait([self.pending.pop(file_date, None)])
+        # pages arrive newest first, a bucket filled from several pages isn't sorted
+        self.pending[file_date] = self.writer_pool.submit(out_file_name, merge_messages([], messages),
+                                                          self.merge or file_date in self.written, self.compact)
+        self.written.add(file_date)
+
+    def close(self):
+        """write out every open day and wait until all day files are written"""
+        while self.buckets:
+            self.flush(next(iter(self.buckets)))
+        pending, self.pending = list(self.pending.values()), {}
+        self.writer_pool.wait(pending)
+
+
+def stream_messages(room_dir, pages, merge=False, manifest=None, checkpoint=None, compact=False, store=None,
+                    channel_id=None, writer_pool=None):
+    """
+    write pages of messages coming from SlackApiAdapter.iter_channel_history through a DayFileWriter
+    Args:
+        store: SqliteStore every page is also upserted into, under channel_id
+        checkpoint: called with the history cursor ('latest') and the newest 'ts' so far every CHECKPOINT_PAGES
+                    pages, once all messages older than the newest one are written out
+    Returns:
+        number of messages written and the newest top-level 'ts' (None if there were no messages)
+    """
+    writer = DayFileWriter(room_dir, merge, manifest=manifest, compact=compact, writer_pool=writer_pool)
+    count = 0
+    newest = None
+    for pages_count, page in enumerate(pages, 1):
+        for message in page:
+            writer.add(message)
+        if store is not None:
+            store.add_messages(channel_id, page)
+        count += len(page)
+        newest = newer_time_stamp(newest, newest_time_stamp(page))
+        if checkpoint is not None and pages_count % CHECKPOINT_PAGES == 0:
+            writer.close()
+            # replies are newer than their parent, the first message of the page is the oldest one of the history
+            checkpoint(page[0]['ts'], newest)
+    writer.close()
+    return count, newest
+
+
+def export_conversation(slack, channel, channel_dir, room_type, exclude_threads, oldest=0, description='channel',
+                        stream=False, manifest=None, journal=None, compact_json=False, store=None, history_shards=1,
+                        writer_pool=None):
+    """
+    Fetch the history of one conversation and write it out as per-day files
+    Args:
+        oldest: only messages newer than this 'ts' are fetched and merged into the existing day files,
+                0 exports the full history
+        stream: write the history page by page instead of collecting the whole conversation in memory first
+        manifest: DownloadManifest collecting the files to download, None if files are not downloaded
+        journal: ExportJournal recording the progress, a streamed conversation continues from its last checkpoint
+        compact_json: write the day files without indentation
+        store: SqliteStore the conversation and its messages are upserted into, None if there is no database
+        history_shards: number of time windows a long history is fetched in concurrently, streams aren't sharded
+        writer_pool: FileWriterPool shared by the conversations, None writes the day files on the calling thread
+    Returns:
+        set of user ids seen in the conversation and the newest top-level 'ts' (None if nothing was fetched)
+    """
+    print(u"Fetching history for {0}: {1}".format(description, channel_dir))
+    mkdir(channel_dir)
+    resumed = journal.in_progress.get(channel['id']) if journal is not None else None
+    merge = oldest != 0 or resumed is not None
+    if store is not None:
+        store.add_conversation(channel, room_type)
+    if stream:
+        channel_members = set()
+        latest = newest = None
+        if resumed is not None:
+            print(u"Resuming {0} from {1}".format(channel_dir, resumed['latest']))
+            latest, newest = resumed['latest'], resumed['newest']
+            channel_members.update(resumed['users'])
+
+        def checkpoint(page_latest, page_newest):
+            journal.checkpoint(channel['id'], page_latest, newer_time_stamp(newest, page_newest), channel_members)
+
+        pages = slack.iter_channel_history(channel['id'], exclude_threads, oldest=oldest, latest=latest,
+                                           users=channel_members)
+        count, stream_newest = stream_messages(channel_dir, pages, merge, manifest,
+                                               checkpoint if journal is not None else None, compact_json, store,
+                                               channel['id'], writer_pool)
+        newest = newer_time_stamp(newest, stream_newest)
+    else:
+        messages, channel_members = slack.get_channel_history(channel['id'], exclude_threads, oldest=oldest,
+                                                              shards=history_shards, created=channel.get('created', 0))
+        parse_messages(channel_dir, messages, merge=merge, manifest=manifest, compact=compact_json,
+                       writer_pool=writer_pool)
+        if store is not None:
+            store.add_messages(channel['id'], messages)
+        count, newest = len(messages), newest_time_stamp(messages)
+    metrics.record_messages(channel['id'], count)
+    if oldest != 0:
+        print(u"{0} new messages in {1}".format(count, channel_dir))
+    if journal is not None:
+        journal.finish(channel['id'], newest, channel_members)
+    return channel_members, newest
+
+
+class DirectoryOutput(object):
+    """write the dump into a directory and zip it once the export is done"""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def has(self, path):
+        """whether a finished file or directory, relative to the directory, is part of the dump"""
+        return os.path.exists(os.path.join(self.directory, path))
+
+    def commit(self, path):
+        pass
+
+    def abort(self):
+        pass
+
+    def close(self):
+        shutil.make_archive(self.directory, 'zip', self.directory, None)
+        shutil.rmtree(self.directory)
+
+
+class ZipOutput(object):
+    """
+    Stream the dump into a zip archive. Files are staged in the directory and moved into the archive as soon as
+    their conversation is finished, so only the conversations in progress are kept on disk twice.
+    Args:
+        compress_level: 0 stores the files uncompressed, 1-9 deflates them, None uses zlib's default
+        append: add to the archive of an interrupted export instead of starting a new one
+    """
+
+    def __init__(self, directory, compress_level=None, append=False):
+        self.directory = os.path.abspath(directory)
+        archive_name = self.directory + '.zip'
+        append = append and os.path.exists(archive_name)
+        # an export that crashed never wrote the central directory, the files moved into its archive are lost
+        self.lost = append and not zipfile.is_zipfile(archive_name)
+        if self.lost:
+            print(u"{0} is incomplete, the conversations moved into it are exported again".format(archive_name))
+        mode = 'a' if append and not self.lost else 'w'
+        compression = zipfile.ZIP_STORED if compress_level == 0 else zipfile.ZIP_DEFLATED
+        self.archive = zipfile.ZipFile(archive_name, mode, compression, compresslevel=compress_level)
+        # top level files and directories in the archive
+        self.archived = set(name.split('/', 1)[0] for name in self.archive.namelist())
+
+    def has(self, path):
+        """
+        whether a finished file or directory, relative to the staging directory, is in the archive or still staged.
+        After a crash nothing staged is trusted, the conversation that was being moved may be half in the lost archive
+        """
+        if path in self.archived:
+            return True
+        return not self.lost and os.path.exists(os.path.join(self.directory, path))
+
+    def commit(self, path):
+        """move a staged file or directory, relative to the staging directory, into the archive"""
+        staged = os.path.join(self.directory, path)
+        if os.path.isdir(staged):
+            for root, subdirs, files in os.walk(staged, topdown=False):
+                for file_name in files:
+                    self._add(os.path.join(root, file_name))
+                os.rmdir(root)
+        elif os.path.isfile(staged):
+            self._add(staged)
+
+    def _add(self, file_name):
+        # leftovers of an interrupted write aren't part of the dump
+        if not file_name.endswith('.tmp'):
+            self.archive.write(file_name, os.path.relpath(file_name, self.directory))
+        os.remove(file_name)
+
+    def abort(self):
+        """finish the archive with what has been committed so far, an export with --resume appends to it"""
+        self.archive.close()
+
+    def close(self):
+        for path in os.listdir(self.directory):
+            self.commit(path)
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
 
-        current_messages.append(message)
-    out_file_name = u'{room}/{file}.json'.format(room=room_dir, file=current_file_date)
-    write_message_file(out_file_name, current_messages)
+def conversation_size(channel):
+    """rough size estimate of a conversation from its conversations.list entry, bigger channels and older ones first"""
+    return channel.get('num_members', 0), -channel.get('created', 0)
 
 
-def downloadFiles(token, cookie_header=None):
+def export_conversations(slack, conversations, exclude_threads, state=None, workers=DEFAULT_WORKERS, stream=False,
+                         manifest=None, journal=None, output=None, profiler=None, compact_json=False, store=None,
+                         history_shards=1, writer_pool=None, order=None):
     """
-    Iterate through all json files, downloads files stored on files.slack.com and replaces the link with a local one
+    Export many conversations at once on a pool of workers, the largest conversations are started first
     Args:
-        jsonDirectory: folder where the json files are in, will be searched recursively
+        conversations: list of (conversation, directory, room type, description) tuples
+        state: high-water marks of an --incremental run, updated with the newest exported 'ts'
+        journal: ExportJournal of the export, conversations it records as finished are skipped if output still has
+                 them
+        output: DirectoryOutput or ZipOutput the finished conversations are committed to
+        profiler: export_metrics.Profiler every conversation is exported under
+        order: conversation ids in the order they are started, e.g. from an export plan, the conversations it
+               doesn't list come after them
+    Returns:
+        set of user ids seen in all conversations
     """
-    print("Starting to download files")
-    for root, subdirs, files in os.walk("."):
-        for filename in files:
-            if not filename.endswith('.json'):
+    users = set()
+    conversations = sorted(conversations, key=lambda conversation: conversation_size(conversation[0]), reverse=True)
+    if order is not None:
+        position = {conversation_id: i for i, conversation_id in enumerate(order)}
+        conversations.sort(key=lambda conversation: position.get(conversation[0]['id'], len(position)))
+    task = export_conversation if profiler is None else profiler.wrap(export_conversation)
+    # nothing is moved once the workers write
+    resolve_room_dirs(conversations)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for channel, channel_dir, room_type, description in conversations:
+            finished = journal.finished.get(channel['id']) if journal is not None else None
+            if finished is not None and output is not None and not output.has(channel_dir):
+                print(u"Exporting {0} {1} again, it is missing from the dump".format(description, channel_dir))
+                finished = None
+            if finished is not None:
+                users.update(finished['users'])
+                if state is not None and finished['newest'] is not None:
+                    state[channel['id']] = finished['newest']
+                print(u"Skipping finished {0}: {1}".format(description, channel_dir))
                 continue
-            filePath = os.path.join(root, filename)
-            data = []
-            with open(filePath) as inFile:
-                data = json.load(inFile)
-                for msg in data:
-                    for slackFile in msg.get("files", []):
-                        # Skip deleted files
-                        if slackFile.get("mode") == "tombstone":
-                            continue
+            oldest = 0
+            if state is not None:
+                oldest = state.get(channel['id'], 0)
+            future = executor.submit(task, slack, channel, channel_dir, room_type, exclude_threads,
+                                     oldest, description, stream, manifest, journal, compact_json, store,
+                                     history_shards, writer_pool)
+            futures[future] = channel, channel_dir, description
+
+        for future in as_completed(futures):
+            channel, channel_dir, description = futures[future]
+            # the workers' results are merged here, on the scheduling thread only
+            channel_members, newest = future.result()
+            users.update(channel_members)
+            if state is not None and newest is not None:
+                state[channel['id']] = newest
+            if output is not None:
+                output.commit(channel_dir)
+            print(u"Finished history for {0}: {1}".format(description, channel_dir))
+    except BaseException:
+        # don't start the queued conversations after a failure or Ctrl-C, the running ones stop at their next
+        # request and are waited for, nothing may write to the dump once this returns
+        slack.rate_limiter.stop()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return users
+
+
+class DownloadProgress(object):
+    """aggregate progress of the download workers, printed at most once per second"""
+
+    def __init__(self, total_files):
+        self.total_files = total_files
+        self.done_files = 0
+        self.skipped_files = 0
+        # (url, error) of the files that could not be downloaded
+        self.failed_files = []
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.printed = 0
+        self.lock = threading.Lock()
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+            self._print()
+
+    def file_done(self, skipped=False):
+        with self.lock:
+            self.done_files += 1
+            if skipped:
+                self.skipped_files += 1
+            self._print()
+
+    def file_failed(self, url, error):
+        with self.lock:
+            self.done_files += 1
+            self.failed_files.append((url, error))
+            self._print()
+
+    def _print(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.printed < 1:
+            return
+        self.printed = now
+        elapsed = max(now - self.started, 0.001)
+        sys.stdout.write("\rDownloaded {0}/{1} files ({2} skipped, {3} failed), {4:.1f} MB, {5:.2f} MB/s ".format(
+            self.done_files, self.total_files, self.skipped_files, len(self.failed_files), self.bytes / 1e6,
+            self.bytes / 1e6 / elapsed))
+        sys.stdout.flush()
+
+    def finish(self):
+        with self.lock:
+            self._print(force=True)
+        print("")
+        for url, error in self.failed_files:
+            print(u"Could not download {0}: {1}".format(url, error))
 
-                        for key, value in slackFile.items():
-                            # Find all entries referring to files on files.slack.com
-                            if not isinstance(value, str) or not value.startswith("https://files.slack.com/"):
-                                continue
 
-                            url = urlparse(value)
+def request_file(session, url, headers, rate_limiter):
+    """GET a file from files.slack.com within the rate limits, honouring Retry-After"""
+    def send():
+        metrics.record_throttled(FILES_HOST, rate_limiter.acquire(FILES_HOST))
+        started = time.perf_counter()
+        r = session.get(url, headers=headers, stream=True, timeout=SlackApiAdapter.DEFAULT_TIMEOUT)
+        # the latency up to the response headers, the body is counted by download_file as it is streamed
+        metrics.record_request(FILES_HOST, time.perf_counter() - started, 0)
+        return r
 
-                            localFile = os.path.join("../files.slack.com",
-                                                     url.path[1:])  # Need to discard first "/" in URL, because:
-                            # "If a component is an absolute path, all previous components are thrown away and joining continues
-                            # from the absolute path component."
-                            print("Downloading %s, saving to %s" % (url.geturl(), localFile))
+    for retry_num in range(SlackApiAdapter.DEFAULT_RETRIES):
+        r = send()
+        if r.status_code != requests.codes.too_many:
+            return r
+        r.close()
+        rate_limiter.retry_after(FILES_HOST, int(r.headers.get('retry-after', SlackApiAdapter.DEFAULT_WAIT)))
+        metrics.record_rate_limited(FILES_HOST)
+    return send()
 
-                            # Create folder structure
-                            os.makedirs(os.path.dirname(localFile), exist_ok=True)
 
-                            # Check if file already downloaded, with same size
-                            if os.path.exists(localFile) and os.path.getsize(localFile) == slackFile.get("size", -1):
-                                print("Skipping already downloaded file: %s" % localFile)
-                                continue
+def download_file(session, url, local_file, headers, rate_limiter, progress):
+    """
+    Stream a file to disk through a '.part' file which is renamed once complete.
+    A '.part' file left behind by an earlier run is resumed with a Range request.
+    """
+    part_file = local_file + '.part'
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    if offset:
+        headers = dict(headers, Range='bytes={0}-'.format(offset))
+
+    with request_file(session, url, headers, rate_limiter) as r:
+        if offset and r.status_code == requests.codes.requested_range_not_satisfiable:
+            # the partial file is already complete
+            os.replace(part_file, local_file)
+            return
+        r.raise_for_status()
+        # the server may ignore the Range header and send the whole file
+        mode = 'ab' if offset and r.status_code == requests.codes.partial_content else 'wb'
+        with open(part_file, mode) as out_file:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                # a big file stops with the rest of the export, the next run resumes it
+                if rate_limiter.stopped.is_set():
+                    raise SlackApiAdapter.Interrupted()
+                out_file.write(chunk)
+                progress.add_bytes(len(chunk))
+                metrics.record_bytes(FILES_HOST, len(chunk))
+    os.replace(part_file, local_file)
+
+
+def files_server_url(url, files_url=None):
+    """url of a file on files.slack.com, moved to the scheme and host of files_url if there is one"""
+    if files_url is None:
+        return url
+    server = urlparse(files_url)
+    return urlparse(url)._replace(scheme=server.scheme, netloc=server.netloc).geturl()
+
+
+def downloadFiles(token, manifest, cookie_header=None, rate_limiter=None, workers=DEFAULT_DOWNLOAD_WORKERS,
+                  files_url=None):
+    """
+    Download the files stored on files.slack.com that were collected in the manifest during the export
+    Args:
+        manifest: DownloadManifest filled by parse_messages
+        rate_limiter: SlackApiAdapter.RateLimiter shared with the API calls
+        workers: number of files downloaded at the same time
+        files_url: server the files are downloaded from instead of https://files.slack.com, only its scheme and host
+                   are used
+    """
+    rate_limiter = rate_limiter or SlackApiAdapter.RateLimiter()
+    print("Starting to download {0} files".format(len(manifest.files)))
+    headers = {"Authorization": "Bearer {}".format(token), **(cookie_header or {})}
+    progress = DownloadProgress(len(manifest.files))
+
+    def download(localFile, url, size):
+        # Create folder structure
+        os.makedirs(os.path.dirname(localFile), exist_ok=True)
+
+        # Check if file already downloaded, with same size
+        if os.path.exists(localFile) and os.path.getsize(localFile) == size:
+            progress.file_done(skipped=True)
+            return
+        try:
+            download_file(session, files_server_url(url, files_url), localFile, headers, rate_limiter, progress)
+        except requests.RequestException as error:
+            # deleted or inaccessible files (404, 403) and files still rate limited after every retry are left out,
+            # the next run tries them again
+            progress.file_failed(url, error)
+            return
+        progress.file_done()
 
-                            # Download files
-                            headers = {"Authorization": "Bearer {}".format(token), **cookie_header}
-                            r = requests.get(url.geturl(), headers=headers)
-                            open(localFile, 'wb').write(r.content)
+    with SlackApiAdapter.create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download, localFile, url, size) for localFile, (url, size) in manifest.files.items()]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            rate_limiter.stop()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    progress.finish()
 
-                            # Replace URL in data - suitable for use with slack-export-viewer if files.slack.com is linked
-                            slackFile[key] = "/static/files.slack.com%s" % url.path
 
-            # Save updated data to json file
-            with open(filePath, "w") as outFile:
-                json.dump(data, outFile, indent=4, sort_keys=True)
+def list_conversations(slack, args, write_lists=True):
+    """
+    the conversations selected on the command line
+    Args:
+        write_lists: dump the conversation lists to channels.json, groups.json, mpims.json and dms.json
+    Returns:
+        list of (conversation, directory, room type, description) tuples
+    """
+    conversations = []
+    if args.privateChannels is not None:
+        private_channels_list = list(filter(lambda conversation: conversation['is_member'], slack.get_conversations('private_channel')))
+        if write_lists:
+            dump_file(private_channels_list, 'private_channels', args.compactJson)
+        print("Fetching messages from", len(private_channels_list), "private channels")
+        for channel in private_channels_list:
+            if args.privateChannels != [] and channel['name'] not in args.privateChannels:
+                print(u"Private channel {0} not in the WhiteList. Passed.".format(channel['name']))
+                continue
+            channel_dir = channel['name']
+            conversations.append((channel, channel_dir, 'group', 'channel'))
 
-            print("Replaced all files in %s" % filePath)
+    if args.publicChannels is not None:
+        public_channels_list = list(filter(lambda conversation: conversation['is_member'], slack.get_conversations('public_channel')))
+        if write_lists:
+            dump_file(public_channels_list, 'public_channels', args.compactJson)
+        print("Fetching messages from", len(public_channels_list), "public channels")
+        for channel in public_channels_list:
+            if args.publicChannels != [] and channel['name'] not in args.publicChannels:
+                print(u"Public channel {0} not in the WhiteList. Passed.".format(channel['name']))
+                continue
+            channel_dir = channel['name']
+            conversations.append((channel, channel_dir, 'channel', 'channel'))
+
+    if args.directGroupMessages is not None:
+        mpim_list = slack.get_conversations('mpim')
+        if write_lists:
+            dump_file(mpim_list, 'mpims', args.compactJson)
+        print("Fetching messages from", len(mpim_list), "direct groups")
+        for channel in mpim_list:
+            channel_dir = channel['name']
+            conversations.append((channel, channel_dir, 'group', 'direct group channel'))
+
+    if args.directMessages is not None:
+        im_list = slack.get_conversations('im')
+        if write_lists:
+            dump_file(im_list, 'im', args.compactJson)
+        print("Fetching messages from", len(im_list), "1:1 conversations")
+        for channel in im_list:
+            channel_dir = channel['id']
+            conversations.append((channel, channel_dir, 'im', '1:1 channel'))
+
+    return conversations
 
 
 if __name__ == "__main__":
@@ -188,6 +881,12 @@ if __name__ == "__main__":
         help="Downloads files from files.slack.com for local access, stored in 'files.slack.com' folder. "
              "Link this folder inside slack-export-viewer/slackviewer/static/ to have it work seamless with slack-export-viewer")
 
+    parser.add_argument(
+        '--downloadWorkers',
+        type=int,
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        help="Number of files downloaded at the same time (default: {0})".format(DEFAULT_DOWNLOAD_WORKERS))
+
     parser.add_argument(
         '--excludeThreads',
         action='store_true',
@@ -195,77 +894,340 @@ if __name__ == "__main__":
         help="Ignore threads"
     )
 
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help="Only fetch messages newer than the previous export and merge them into the existing dump. "
+             "The newest exported message per conversation is kept in '{0}'".format(STATE_FILE)
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of conversations exported at the same time (default: {0})".format(DEFAULT_WORKERS)
+    )
+
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help="Write the history page by page instead of loading whole conversations into memory. "
+             "Use it for very big channels"
+    )
+
+    parser.add_argument(
+        '--writeWorkers',
+        type=int,
+        default=0,
+        help="Number of day files encoded and written at the same time, 0 writes them on the export workers "
+             "(default: 0)"
+    )
+
+    parser.add_argument(
+        '--writeProcesses',
+        action='store_true',
+        default=False,
+        help="Encode the day files in --writeWorkers processes instead of threads. Pays off for the indented "
+             "output, which Python encodes slowly, less so with --compactJson"
+    )
+
+    parser.add_argument(
+        '--historyShards',
+        type=int,
+        default=1,
+        help="Split the history of a conversation with more than one page into this many time windows, from its "
+             "creation to its newest page, and fetch them at the same time. Not used with --stream (default: 1)"
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help="Continue an interrupted export, finished conversations are skipped and streamed ones continue from "
+             "their last checkpoint. The progress is kept in '{0}'".format(JOURNAL_FILE)
+    )
+
+    parser.add_argument(
+        '--output',
+        choices=['zip', 'directory'],
+        default='zip',
+        help="'zip' streams finished conversations straight into {0}.zip, 'directory' writes the '{0}' directory "
+             "and zips it at the end (default: zip)".format(OUTPUT_DIRECTORY)
+    )
+
+    parser.add_argument(
+        '--compressLevel',
+        type=int,
+        choices=range(10),
+        default=None,
+        metavar='0-9',
+        help="Compression level of the zip output, 0 stores the files uncompressed"
+    )
+
+    parser.add_argument(
+        '--fieldPreset',
+        choices=sorted(SlackApiAdapter.PROJECTION_PRESETS),
+        default=None,
+        help="Drop message fields as they are fetched: 'viewer-minimal' keeps what slack-export-viewer shows, "
+             "'no-blocks' drops the rich text blocks and user profile copies"
+    )
+
+    parser.add_argument(
+        '--keepFields',
+        nargs='*',
+        default=None,
+        metavar='FIELD',
+        help="Keep only these message fields, in addition to the preset's and the ones the export needs"
+    )
+
+    parser.add_argument(
+        '--dropFields',
+        nargs='*',
+        default=None,
+        metavar='FIELD',
+        help="Drop these message fields, e.g. --dropFields blocks reactions"
+    )
+
+    parser.add_argument(
+        '--compactJson',
+        action='store_true',
+        default=False,
+        help="Write the dump without indentation, smaller and faster to write. Uses orjson when it is installed"
+    )
+
+    parser.add_argument(
+        '--rateLimitScale',
+        type=float,
+        default=1.0,
+        help="Factor applied to Slack's rate limits, e.g. 0.5 if another export shares the token (default: 1.0)"
+    )
+
+    parser.add_argument(
+        '--apiUrl',
+        default=SlackApiAdapter.API_URL,
+        help="Slack API endpoint, to test against a stand-in such as bench/fake_slack.py"
+    )
+
+    parser.add_argument(
+        '--filesUrl',
+        default=None,
+        metavar='URL',
+        help="Download the files.slack.com files from this scheme and host instead, to test against a stand-in"
+    )
+
+    parser.add_argument(
+        '--sqlite',
+        default=None,
+        metavar='FILE',
+        help="Also upsert every message, conversation and user into a SQLite database with a full-text index, "
+             "search it with python sqlite_store.py FILE QUERY"
+    )
+
+    parser.add_argument(
+        '--replyCache',
+        default=None,
+        metavar='FILE',
+        help="Keep the replies of every fetched thread in FILE, threads whose latest reply and reply count haven't "
+             "changed are served from it on the next export instead of calling conversations.replies"
+    )
+
+    parser.add_argument(
+        '--userCache',
+        default=None,
+        metavar='FILE',
+        help="Keep the profiles of the exported users in FILE, the next export only looks up users missing from it"
+    )
+
+    parser.add_argument(
+        '--userCacheTtl',
+        type=float,
+        default=user_resolver.DEFAULT_TTL / 3600,
+        metavar='HOURS',
+        help="Hours a cached profile is used before it is looked up again (default: {0:g})".format(
+            user_resolver.DEFAULT_TTL / 3600)
+    )
+
+    parser.add_argument(
+        '--workspaceSize',
+        type=int,
+        default=None,
+        metavar='MEMBERS',
+        help="Number of members of the workspace, users are then read from users.list when that takes less of the "
+             "rate limits than users.info lookups (default: the size the user cache remembers)"
+    )
+
+    parser.add_argument(
+        '--plan',
+        default=None,
+        metavar='FILE',
+        help="Dry run: sample the newest page of every conversation, estimate the API calls, the time the rate "
+             "limits need and the size of the output, and write the plan to FILE without exporting anything"
+    )
+
+    parser.add_argument(
+        '--usePlan',
+        default=None,
+        metavar='FILE',
+        help="Start the conversations in the order of a plan written by --plan"
+    )
+
+    parser.add_argument(
+        '--metricsFile',
+        default=METRICS_FILE,
+        help="JSON file the export's metrics are written to: API calls, latencies, rate limiting, bytes received, "
+             "pages and messages per conversation and time spent writing JSON (default: {0})".format(METRICS_FILE)
+    )
+
+    parser.add_argument(
+        '--prometheusFile',
+        default=None,
+        metavar='FILE',
+        help="Also write the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector"
+    )
+
+    parser.add_argument(
+        '--profile',
+        default=None,
+        metavar='FILE',
+        help="Profile the export with cProfile and write the stats to FILE, read them with python -m pstats FILE"
+    )
+
     args = parser.parse_args()
     cookie_header = {'cookie': args.cookie}
 
-    slack = SlackApiAdapter.SlackApiAdapter(headers=cookie_header, token=args.token)
+    projection = None
+    if args.fieldPreset or args.keepFields is not None or args.dropFields:
+        projection = SlackApiAdapter.FieldProjection.from_preset(args.fieldPreset, args.keepFields, args.dropFields)
+    replies = None
+    if args.replyCache:
+        replies = reply_cache.ReplyCache(args.replyCache, '' if projection is None else projection.key())
+    user_cache = user_resolver.UserCache(args.userCache, args.userCacheTtl * 3600) if args.userCache else None
+    profiler = export_metrics.Profiler() if args.profile else None
+    # every history window of every export worker and every reply worker may hold a connection at the same time
+    slack = SlackApiAdapter.SlackApiAdapter(headers=cookie_header, token=args.token,
+                                            rate_limiter=SlackApiAdapter.RateLimiter(scale=args.rateLimitScale),
+                                            pool_size=args.workers * args.historyShards +
+                                            SlackApiAdapter.DEFAULT_REPLY_WORKERS,
+                                            api_url=args.apiUrl, metrics=metrics, reply_cache=replies,
+                                            projection=projection, profiler=profiler)
+    metrics_file = os.path.abspath(args.metricsFile)
+    prometheus_file = os.path.abspath(args.prometheusFile) if args.prometheusFile else None
+    profile_file = os.path.abspath(args.profile) if args.profile else None
+
+    def write_metrics():
+        metrics.write_json(metrics_file)
+        if prometheus_file:
+            metrics.write_prometheus(prometheus_file)
+        if profiler is not None:
+            profiler.dump(profile_file)
 
     users_white_list = set()
+    state_file = os.path.abspath(STATE_FILE)
+    state = load_state(state_file) if args.incremental else None
+
+    if args.plan:
+        # a dry run, nothing is written but the plan
+        conversations = list_conversations(slack, args, write_lists=False)
+        list_calls = metrics.to_dict()['methods'].get('conversations.list', {}).get('calls', 0)
+        plan = export_planner.plan_export(slack, conversations, args.excludeThreads, state, args.workers,
+                                          list_calls)
+        export_planner.write_plan(args.plan, plan)
+        export_planner.print_plan(plan)
+        print("Plan written to {0}, export in its order with --usePlan {0}".format(args.plan))
+        for cache in (replies, user_cache):
+            if cache is not None:
+                cache.close()
+        slack.close()
+        exit()
+    order = export_planner.load_plan_order(args.usePlan) if args.usePlan else None
+
+    if args.incremental:
+        # continue from the previous archive, the dump directory is removed after zipping
+        if not os.path.isdir(OUTPUT_DIRECTORY) and os.path.exists(OUTPUT_DIRECTORY + '.zip'):
+            shutil.unpack_archive(OUTPUT_DIRECTORY + '.zip', OUTPUT_DIRECTORY)
+    manifest = DownloadManifest() if args.downloadSlackFiles else None
+    journal_file = os.path.abspath(JOURNAL_FILE)
+    if args.resume:
+        journal = ExportJournal.load(journal_file, manifest)
+    else:
+        journal = ExportJournal(journal_file, manifest)
+        journal.remove()
+    writer_pool = FileWriterPool(args.writeWorkers, args.writeProcesses, profiler)
+    # messages already in the database are updated in place
+    store = sqlite_store.SqliteStore(args.sqlite) if args.sqlite else None
     mkdir(OUTPUT_DIRECTORY)
+    if args.output == 'zip' and args.incremental:
+        print("--incremental merges into the previous dump, writing the '{0}' directory".format(OUTPUT_DIRECTORY))
+        args.output = 'directory'
+    if args.output == 'zip':
+        output = ZipOutput(OUTPUT_DIRECTORY, args.compressLevel, append=args.resume)
+    else:
+        output = DirectoryOutput(OUTPUT_DIRECTORY)
     os.chdir(OUTPUT_DIRECTORY)
 
-    if args.privateChannels is not None:
-        private_channels_list = list(filter(lambda conversation: conversation['is_member'], slack.get_conversations('private_channel')))
-        dump_file(private_channels_list, 'private_channels')
-        print("Fetching messages from", len(private_channels_list), "private channels")
-        for channel in private_channels_list:
-            if args.privateChannels != [] and channel['name'] not in args.privateChannels:
-                print(u"Private channel {0} not in the WhiteList. Passed.".format(channel['name']))
-                continue
-            channel_dir = channel['name']
-            print(u"Fetching history for channel: {0}".format(channel_dir))
-            mkdir(channel_dir)
-            messages, channel_members = slack.get_channel_history(channel['id'], args.excludeThreads)
-            users_white_list.update(channel_members)
-            parse_messages(channel_dir, messages, 'group')
+    if args.incremental and os.path.exists('users.json'):
+        # keep the authors of previously exported messages in users.json
+        with open('users.json', 'rb') as inFile:
+            users_white_list.update(user['id'] for user in json_backend.loads(inFile.read()))
 
-    if args.publicChannels is not None:
-        public_channels_list = list(filter(lambda conversation: conversation['is_member'], slack.get_conversations('public_channel')))
-        dump_file(public_channels_list, 'public_channels')
-        print("Fetching messages from", len(public_channels_list), "public channels")
-        for channel in public_channels_list:
-            if args.publicChannels != [] and channel['name'] not in args.publicChannels:
-                print(u"Public channel {0} not in the WhiteList. Passed.".format(channel['name']))
-                continue
-            channel_dir = channel['name']
-            print(u"Fetching history for channel: {0}".format(channel_dir))
-            mkdir(channel_dir)
-            messages, channel_members = slack.get_channel_history(channel['id'], args.excludeThreads)
-            users_white_list.update(channel_members)
-            parse_messages(channel_dir, messages, 'channel')
+    conversations = list_conversations(slack, args)
 
-    if args.directGroupMessages is not None:
-        mpim_list = slack.get_conversations('mpim')
-        dump_file(mpim_list, 'mpims')
-        print("Fetching messages from", len(mpim_list), "direct groups")
-        for channel in mpim_list:
-            channel_dir = channel['name']
-            print(u"Fetching history for direct group  channel: {0}".format(channel_dir))
-            mkdir(channel_dir)
-            messages, channel_members = slack.get_channel_history(channel['id'], args.excludeThreads)
-            users_white_list.update(channel_members)
-            parse_messages(channel_dir, messages, 'group')
+    try:
+        users_white_list.update(export_conversations(slack, conversations, args.excludeThreads, state, args.workers,
+                                                     args.stream, manifest, journal, output, profiler,
+                                                     args.compactJson, store, args.historyShards, writer_pool,
+                                                     order))
 
-    if args.directMessages is not None:
-        im_list = slack.get_conversations('im')
-        dump_file(im_list, 'im')
-        print("Fetching messages from", len(im_list), "1:1 conversations")
-        for channel in im_list:
-            channel_dir = channel['id']
-            print(u"Fetching history for 1:1 channel: {0}".format(channel_dir))
-            mkdir(channel_dir)
-            messages, channel_members = slack.get_channel_history(channel['id'], args.excludeThreads)
-            users_white_list.update(channel_members)
-            parse_messages(channel_dir, messages, 'im')
+        resolver = user_resolver.UserResolver(slack, user_cache, args.workspaceSize)
+        if profiler is not None:
+            users = profiler.runcall(resolver.resolve, users_white_list)
+        else:
+            users = resolver.resolve(users_white_list)
+        print(f"Users in chats:{len(users)}")
+        dump_file(users, 'users', args.compactJson)
+        if store is not None:
+            store.add_users(users)
 
-    users = list(filter(lambda user: user['id'] in users_white_list, slack.get_users()))
-    print(f"Users in chats:{len(users)}")
-    dump_file(users, 'users')
+        if args.downloadSlackFiles:
+            downloadFiles(token=args.token, manifest=manifest, cookie_header=cookie_header,
+                          rate_limiter=slack.rate_limiter, workers=args.downloadWorkers, files_url=args.filesUrl)
+    except BaseException:
+        # stop and wait for every thread still talking to Slack before closing what they write to
+        slack.rate_limiter.stop()
+        slack.close()
+        if store is not None:
+            store.close()
+        if replies is not None:
+            replies.close()
+        if user_cache is not None:
+            user_cache.close()
+        writer_pool.close()
+        output.abort()
+        print(u"\nExport interrupted, '{0}' is kept. Run again with --resume to continue.".format(OUTPUT_DIRECTORY))
+        write_metrics()
+        raise
 
-    if args.downloadSlackFiles:
-        downloadFiles(token=args.token, cookie_header=cookie_header)
+    print("Time spent throttled: {0:.1f}s, rate limit responses: {1}".format(slack.rate_limiter.throttled_seconds,
+                                                                            slack.rate_limiter.rate_limited))
+    connection_stats = slack.connection_stats()
+    print("API requests: {0} over {1} connections".format(connection_stats['requests'],
+                                                         connection_stats['connections']))
+    if replies is not None:
+        print("Threads served from the reply cache: {0} of {1}".format(replies.hits, replies.hits + replies.misses))
+        replies.close()
+    if user_cache is not None:
+        user_cache.close()
+    writer_pool.close()
+    slack.close()
+    write_metrics()
+    if store is not None:
+        store.close()
 
     os.chdir('..')
-    shutil.make_archive("dump", 'zip', OUTPUT_DIRECTORY, None)
-    shutil.rmtree(OUTPUT_DIRECTORY)
+    output.close()
+    if state is not None:
+        save_state(state_file, state)
+    journal.remove()
     exit()
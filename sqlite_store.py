@@ -0,0 +1,159 @@
+"""
+SQLite copy of an export: every message, reply, conversation and user is upserted into one database next to the
+JSON dump, with a full-text index over the message text. Search it from the command line:
+
+    python sqlite_store.py dump.sqlite "deploy AND friday"
+"""
+import argparse
+import sqlite3
+import threading
+from datetime import datetime
+
+import json_backend
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    real_name TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    user TEXT,
+    thread_ts TEXT,
+    date TEXT,
+    subtype TEXT,
+    text TEXT,
+    data TEXT,
+    PRIMARY KEY (channel_id, ts)
+);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user);
+CREATE INDEX IF NOT EXISTS messages_thread ON messages (channel_id, thread_ts);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+"""
+
+# the full-text index reads the text from the messages table, the triggers keep it up to date
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+"""
+
+UPSERT_MESSAGE = """
+INSERT INTO messages (channel_id, ts, user, thread_ts, date, subtype, text, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (channel_id, ts) DO UPDATE SET
+    user = excluded.user, thread_ts = excluded.thread_ts, date = excluded.date, subtype = excluded.subtype,
+    text = excluded.text, data = excluded.data
+"""
+
+
+def encode(data):
+    return json_backend.dumps_compact(data).decode('utf-8')
+
+
+def message_date(ts):
+    """day of a message, the same as the name of its day file"""
+    return '{:%Y-%m-%d}'.format(datetime.utcfromtimestamp(float(ts)))
+
+
+class SqliteDatabase(object):
+    """
+    SQLite connection shared by many threads, every use of it holds the lock. The database is written in WAL mode,
+    which commits without syncing to disk every time.
+    """
+
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SqliteStore(SqliteDatabase):
+    """
+    Upsert the export into a SQLite database, keyed by (channel_id, ts) for messages and by id otherwise, so a
+    repeated or incremental export updates the database in place. Safe to use from many export workers.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            try:
+                self.connection.executescript(FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                print("SQLite is built without FTS5, messages are stored without a full-text index")
+                self.full_text = False
+
+    def add_conversation(self, conversation, room_type):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO conversations (id, name, type, data) VALUES (?, ?, ?, ?)',
+                (conversation['id'], conversation.get('name'), room_type, encode(conversation)))
+
+    def add_messages(self, channel_id, messages):
+        """upsert messages and replies of a conversation in one transaction"""
+        rows = [(channel_id, message['ts'], message.get('user'), message.get('thread_ts'),
+                 message_date(message['ts']), message.get('subtype'), message.get('text'), encode(message))
+                for message in messages]
+        with self.lock, self.connection:
+            self.connection.executemany(UPSERT_MESSAGE, rows)
+
+    def add_users(self, users):
+        rows = [(user['id'], user.get('name'), user.get('real_name'), encode(user)) for user in users]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO users (id, name, real_name, data) VALUES (?, ?, ?, ?)', rows)
+
+    def search(self, query, limit=20):
+        """
+        full-text search over the message text, best matches first
+        Args:
+            query: FTS5 query, e.g. 'deploy AND friday' or '"exact phrase"'
+        Returns:
+            list of (conversation name, date, user name, text) tuples
+        """
+        with self.lock:
+            return self.connection.execute(
+                """SELECT conversations.name, messages.date, users.name, messages.text
+                   FROM messages_fts
+                   JOIN messages ON messages.rowid = messages_fts.rowid
+                   LEFT JOIN conversations ON conversations.id = messages.channel_id
+                   LEFT JOIN users ON users.id = messages.user
+                   WHERE messages_fts MATCH ?
+                   ORDER BY rank LIMIT ?""", (query, limit)).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search the SQLite database of an export')
+    parser.add_argument('database', help="Database written by slack_export.py --sqlite")
+    parser.add_argument('query', help="FTS5 query, e.g. 'deploy AND friday'")
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    store = SqliteStore(args.database)
+    for name, date, user, text in store.search(args.query, args.limit):
+        print(u"#{0} {1} {2}: {3}".format(name, date, user, text))
+    store.close()
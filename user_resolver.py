@@ -0,0 +1,135 @@
+import math
+import time
+
+import json_backend
+import sqlite_store
+
+# seconds a cached profile is used before it is looked up again
+DEFAULT_TTL = 24 * 60 * 60
+# members per users.list page
+USERS_LIST_PAGE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    fetched REAL,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS workspace (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+
+class UserCache(sqlite_store.SqliteDatabase):
+    """
+    Profiles looked up by earlier exports, kept in a SQLite file for ttl seconds, and the number of members the
+    last complete users.list returned.
+    """
+
+    def __init__(self, file_name, ttl=DEFAULT_TTL):
+        super().__init__(file_name)
+        self.ttl = ttl
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def get(self, user_ids):
+        """the cached profiles that haven't expired, by user id"""
+        oldest = time.time() - self.ttl
+        users = {}
+        with self.lock:
+            for user_id in user_ids:
+                row = self.connection.execute('SELECT fetched, data FROM users WHERE id = ?', (user_id,)).fetchone()
+                if row is not None and row[0] >= oldest:
+                    users[user_id] = json_backend.loads(row[1])
+        return users
+
+    def put(self, users):
+        now = time.time()
+        rows = [(user['id'], now, json_backend.dumps_compact(user).decode('utf-8')) for user in users]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO users (id, fetched, data) VALUES (?, ?, ?)', rows)
+
+    @property
+    def member_count(self):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM workspace WHERE key = 'member_count'").fetchone()
+        return row[0] if row is not None else None
+
+    @member_count.setter
+    def member_count(self, count):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO workspace (key, value) VALUES ('member_count', ?)",
+                                    (count,))
+
+
+class UserResolver(object):
+    """
+    Look up the profiles of the users an export needs, instead of downloading the whole workspace directory.
+    Unknown users are looked up with users.info, several at a time, unless paging through users.list takes less of
+    the rate limits. users.list is then filtered page by page and stops as soon as every user is found.
+    Args:
+        slack: SlackApiAdapter.SlackApiAdapter
+        cache: UserCache the profiles are served from and stored in, None looks up every user
+        member_count: number of members of the workspace, None uses the one the cache remembers
+    """
+
+    def __init__(self, slack, cache=None, member_count=None):
+        self.slack = slack
+        self.cache = cache
+        self.member_count = member_count
+
+    def resolve(self, user_ids):
+        """
+        Returns:
+            list of the profiles of user_ids sorted by id, users that don't exist are left out
+        """
+        user_ids = set(user_id for user_id in user_ids if user_id)
+        users = self.cache.get(user_ids) if self.cache is not None else {}
+        missing = user_ids.difference(users)
+        if users:
+            print("{0} users from the user cache".format(len(users)))
+        if missing:
+            if self._list_is_cheaper(len(missing)):
+                print("Looking up {0} users in users.list".format(len(missing)))
+                found = self._from_list(missing)
+            else:
+                print("Looking up {0} users with users.info".format(len(missing)))
+                found = [user for user in self.slack.get_users_info(sorted(missing)) if user is not None]
+            if self.cache is not None:
+                self.cache.put(found)
+            users.update((user['id'], user) for user in found)
+        return [users[user_id] for user_id in sorted(users)]
+
+    def _list_is_cheaper(self, missing):
+        """compare the minutes of rate limit both ways take, users.list is only used for a known workspace size"""
+        member_count = self.member_count
+        if member_count is None and self.cache is not None:
+            member_count = self.cache.member_count
+        if member_count is None:
+            # users.list may have to be read to its end, a big workspace takes longer than any users.info lookup
+            return False
+        rate_limiter = self.slack.rate_limiter
+        info_minutes = missing / rate_limiter.rate('users.info')
+        list_minutes = math.ceil(member_count / USERS_LIST_PAGE) / rate_limiter.rate('users.list')
+        return list_minutes < info_minutes
+
+    def _from_list(self, missing):
+        """filter users.list page by page, stops once every missing user is found"""
+        missing = set(missing)
+        found = []
+        member_count = 0
+        for members in self.slack.iter_users():
+            member_count += len(members)
+            for member in members:
+                if member['id'] in missing:
+                    missing.discard(member['id'])
+                    found.append(member)
+            if not missing:
+                break
+        else:
+            # the whole directory was read, remember its size for the next export
+            if self.cache is not None:
+                self.cache.member_count = member_count
+        return found